@@ -0,0 +1,252 @@
+"""Benchmark new.py against a fixed corpus of synthetic CSC115 midterm submissions
+
+Usage: python bench.py [-n 60] [--jobs 4] [--modes serial,processes,threads]
+
+Every mode grades a fresh copy of the same generated corpus with
+`new.py --no-cache` in a subprocess, then reads the timings each submission
+left in its trace.json. The report (throughput, per-phase latency, peak
+memory) is printed and written to bench_output.txt.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from new import TRACE_FILE, percentile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STUDENT_INFO = '''
+def show_student_information():
+    # Print the student's contact details
+    print("Full Name: {name}")
+    print("Email: {email}@miami.edu")
+    print("Major: Computer Science")
+    print("Course: CSC115")
+    print("Semester: Spring 2025")
+'''
+
+ROMAN_BINARY = '''
+def show_roman_binary_number():
+    # Ask for a number between 1 and 10 until the user enters one
+    numerals = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X"]
+    number = 0
+    while number < 1 or number > 10:
+        answer = input("Enter a number (1-10): ")
+        if answer.lstrip("-").isdigit():
+            number = int(answer)
+        if number < 1 or number > 10:
+            print("Error: the number must be between 1 and 10.")
+    # Show the roman numeral and the binary value
+    print(f"Roman Numeral: {numerals[number - 1]}")
+    print(f"Binary Value: {bin(number)[2:]}")
+'''
+
+POPULATION = '''
+def show_population():
+    # Three validated inputs: organisms, daily increase and days
+    organisms = 0
+    while organisms < 2:
+        organisms = float(input("Enter the starting number of organisms: "))
+    increase = 0
+    while increase <= 0 or increase > 100:
+        increase = float(input("Enter the average daily increase (%): "))
+    days = 0
+    while days < 2 or days > 30:
+        days = int(input("Enter the number of days to multiply: "))
+    # Print the table, one line per day
+    print("Day Approximate Population")
+    population = organisms
+    for day in range(1, days + 1):
+        print(f"{day} {population:.2f}")
+        population = population + population * increase / 100
+'''
+
+MENU = '''
+def main():
+    # Show the menu until the user picks 9
+    option = ""
+    while option != "9":
+        print("1. Student information  2. Roman/Binary  3. Population  9. Exit")
+        option = input("Enter an option: ")
+        if option == "1":
+            show_student_information()
+        elif option == "2":
+            show_roman_binary_number()
+        elif option == "3":
+            show_population()
+'''
+
+# A menu that ignores 9, the grader has to stop it once the scripted inputs run out
+ENDLESS_MENU = '''
+def main():
+    # Show the menu forever
+    while True:
+        print("1. Student information  2. Roman/Binary  3. Population")
+        option = input("Enter an option: ")
+        if option == "1":
+            show_student_information()
+        elif option == "2":
+            show_roman_binary_number()
+        elif option == "3":
+            show_population()
+'''
+
+HEAVY_PRINTER = '''
+def show_population():
+    # Print a huge table without validating anything
+    organisms = float(input("Enter the starting number of organisms: "))
+    for day in range(1, 1000000):
+        print(f"Day {day} Approximate Population {organisms * day:.2f}")
+'''
+
+FILE_WRITER = '''
+def show_population():
+    # Validate the three inputs and save the table to population.txt
+    organisms = 0
+    while organisms < 2:
+        organisms = float(input("Enter the starting number of organisms: "))
+    increase = 0
+    while increase <= 0:
+        increase = float(input("Enter the average daily increase (%): "))
+    days = 0
+    while days < 2:
+        days = int(input("Enter the number of days to multiply: "))
+    with open("population.txt", "w") as table:
+        population = organisms
+        for day in range(1, days + 1):
+            table.write(f"{day} {population:.2f}\\n")
+            population = population + population * increase / 100
+    print("Day Approximate Population saved to population.txt")
+'''
+
+SYNTAX_ERROR = '''
+def main()
+    print("Enter an option:"
+'''
+
+# kind -> (share of the corpus, function sources)
+SUBMISSION_KINDS = {
+    "correct": (0.4, [STUDENT_INFO, ROMAN_BINARY, POPULATION, MENU]),
+    "missing_functions": (0.15, [STUDENT_INFO, MENU]),
+    "endless_menu": (0.15, [STUDENT_INFO, ROMAN_BINARY, POPULATION, ENDLESS_MENU]),
+    "heavy_printer": (0.1, [STUDENT_INFO, ROMAN_BINARY, HEAVY_PRINTER, MENU]),
+    "file_writer": (0.1, [STUDENT_INFO, ROMAN_BINARY, FILE_WRITER, MENU]),
+    "syntax_error": (0.1, [SYNTAX_ERROR]),
+}
+
+def generate_corpus(directory, count, seed=115):
+    """Write count synthetic submissions with Blackboard file names, returns {file name: kind}"""
+    rng = random.Random(seed)
+    kinds = list(SUBMISSION_KINDS)
+    weights = [SUBMISSION_KINDS[kind][0] for kind in kinds]
+    corpus = {}
+    for index in range(count):
+        kind = kinds[index] if index < len(kinds) else rng.choices(kinds, weights)[0]
+        student_id = f"c9{index:07d}"
+        # Unique names and text per submission, like a real class
+        source = f"# Midterm project of student {student_id}\n"
+        for function_source in SUBMISSION_KINDS[kind][1]:
+            source += function_source.replace("{name}", f"Student {index}").replace("{email}", f"s{index}")
+        if kind != "syntax_error":
+            source += "\nmain()\n"
+        file_name = f"Middle Term Project_{student_id}_attempt_2025-03-20-12-00-00_{kind}.py"
+        with open(os.path.join(directory, file_name), "w") as f:
+            f.write(source)
+        corpus[file_name] = kind
+    return corpus
+
+def run_mode(corpus_dir, work_dir, mode, jobs):
+    """Grade a fresh copy of the corpus in one mode, returns its measurements"""
+    run_dir = os.path.join(work_dir, mode)
+    shutil.copytree(corpus_dir, run_dir)
+    for support_file in ("new.py", "input.txt", "testcases.json"):
+        if os.path.exists(os.path.join(REPO_DIR, support_file)):
+            shutil.copy(os.path.join(REPO_DIR, support_file), run_dir)
+
+    command = [sys.executable, "new.py", "--no-cache"]
+    if mode != "serial":
+        command += ["-j", str(jobs)]
+    if mode == "threads":
+        command.append("--threads")
+    started = time.perf_counter()
+    with open(os.path.join(run_dir, "grader.log"), "w") as log:
+        completed = subprocess.run(command, cwd=run_dir, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - started
+
+    timings = []
+    for folder in os.listdir(run_dir):
+        trace_path = os.path.join(run_dir, folder, TRACE_FILE)
+        if os.path.isfile(trace_path):
+            with open(trace_path, "r", encoding="utf-8") as f:
+                trace_timings = json.load(f).get("timings")
+            if trace_timings:
+                timings.append(trace_timings)
+    return {"mode": mode, "jobs": 1 if mode == "serial" else jobs, "returncode": completed.returncode,
+            "wall": wall, "graded": len(timings), "timings": timings}
+
+def format_report(count, runs):
+    """Plain text report of every mode's run"""
+    lines = [f"Synthetic corpus: {count} submissions, kinds: {', '.join(SUBMISSION_KINDS)}", ""]
+    lines.append(f"{'mode':<10}{'jobs':>5}{'graded':>8}{'wall s':>9}{'subs/s':>9}"
+                 f"{'p50 s':>9}{'p95 s':>9}{'max s':>9}{'grader MB':>11}{'sandbox MB':>12}")
+    for run in runs:
+        totals = sorted(timing["total"] for timing in run["timings"]) or [0.0]
+        grader_rss = max((timing["grader_peak_rss_kb"] for timing in run["timings"]), default=0)
+        sandbox_rss = max((timing["sandbox_peak_rss_kb"] for timing in run["timings"]), default=0)
+        status = "" if run["returncode"] == 0 else f"  (exit code {run['returncode']})"
+        lines.append(f"{run['mode']:<10}{run['jobs']:>5}{run['graded']:>8}{run['wall']:>9.2f}{count / run['wall']:>9.1f}"
+                     f"{percentile(totals, 0.5):>9.4f}{percentile(totals, 0.95):>9.4f}{totals[-1]:>9.4f}"
+                     f"{grader_rss / 1024:>11.1f}{sandbox_rss / 1024:>12.1f}{status}")
+
+    for run in runs:
+        phases = {}
+        for timing in run["timings"]:
+            for phase, seconds in timing["phases"].items():
+                phases.setdefault(phase, []).append(seconds)
+        lines += ["", f"Per-phase latency, {run['mode']} (seconds)",
+                  f"{'phase':<14}{'p50':>10}{'p95':>10}{'max':>10}"]
+        for phase, values in phases.items():
+            values.sort()
+            lines.append(f"{phase:<14}{percentile(values, 0.5):>10.4f}{percentile(values, 0.95):>10.4f}{values[-1]:>10.4f}")
+    return "\n".join(lines) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark new.py on synthetic CSC115 submissions")
+    parser.add_argument("-n", "--count", type=int, default=60, help="number of submissions to generate (default 60)")
+    parser.add_argument("-j", "--jobs", type=int, default=max(2, os.cpu_count() or 1),
+                        help="workers for the parallel modes (default: CPU count, at least 2)")
+    parser.add_argument("--modes", default="serial,processes,threads",
+                        help="comma separated modes to run: serial, processes, threads")
+    parser.add_argument("--seed", type=int, default=115, help="corpus seed, the same seed gives the same corpus")
+    parser.add_argument("--output", default="bench_output.txt", help="where to write the report (default bench_output.txt)")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory with every run's output")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="grader_bench_")
+    try:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        os.makedirs(corpus_dir)
+        generate_corpus(corpus_dir, args.count, args.seed)
+        runs = []
+        for mode in args.modes.split(","):
+            print(f"Grading {args.count} submissions: {mode}")
+            runs.append(run_mode(corpus_dir, work_dir, mode.strip(), args.jobs))
+        report = format_report(args.count, runs)
+        print("\n" + report)
+        with open(args.output, "w") as f:
+            f.write(report)
+        print(f"Report written to {args.output}")
+    finally:
+        if args.keep:
+            print(f"Runs kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -9,16 +9,74 @@ import traceback
 import glob
 import builtins
 import time
+import gc
 import signal
 import threading
+import multiprocessing
+import marshal
+import atexit
+import resource
+import select
+import struct
+import ctypes
+import ctypes.util
 import ast
 import types
 import csv
+import json
+import hashlib
+import base64
+import math
+import zlib
+import random
+import difflib
+import bisect
+import argparse
+import cProfile
+import logging
+import pstats
+import tempfile
+import zipfile
+from datetime import datetime
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+log = logging.getLogger("autograder")
+# --log-level names: quiet shows only problems, summary adds progress and the batch
+# summaries, debug adds per-submission messages and source dumps
+LOG_LEVELS = {"quiet": logging.WARNING, "summary": logging.INFO, "debug": logging.DEBUG}
+
+class LazyText:
+    """Log argument that is only built when a handler actually formats the record"""
+
+    def __init__(self, build):
+        self.build = build
+
+    def __str__(self):
+        return self.build()
+
+class ConsoleHandler(logging.StreamHandler):
+    """Writes log lines to stdout, clearing the live progress line first"""
+
+    def emit(self, record):
+        if _progress_line is not None:
+            _progress_line.clear()
+        super().emit(record)
+
+def setup_logging(level_name="summary"):
+    """Send the grader's messages to stdout at one of the LOG_LEVELS"""
+    log.setLevel(LOG_LEVELS[level_name])
+    if not log.handlers:
+        handler = ConsoleHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
 
 RUBRIC = [
     {
         "type": "output",
         "phrase": "Full Name:",
+        "match": {"literal": "@miami"},
         "points": 5,
         "description": "Displays name, email, major, course, semester in the first 5 lines of output"
     },
@@ -55,6 +113,7 @@ RUBRIC = [
     {
         "type": "output",
         "phrase": "Binary Value",
+        "match": {"literal": "101"},
         "points": 5,
         "description": "Roman numeral and binary output formatted correctly"
     },
@@ -73,6 +132,7 @@ RUBRIC = [
     {
         "type": "output",
         "phrase": "Approximate Population",
+        "match": {"number": 21.21, "tolerance": 0.005},
         "points": 10,
         "description": "Average daily population increase calculated and output correctly"
     },
@@ -84,35 +144,296 @@ RUBRIC = [
     }
 ]
 
-def extract_function_code(file_path, func_name):
-    with open(file_path) as f:
-        tree = ast.parse(f.read())
+# Functions pulled out of each submission, in the order they are put back together
+GRADED_FUNCTIONS = ["main", "show_student_information", "show_roman_binary_number", "show_population"]
+
+class SubmissionAST:
+    """A student submission that has been read and parsed exactly once
+
+    Function lookup, the virtual module and the static rubric checks all work
+    off this one tree instead of re-reading and re-parsing the file.
+    Raises SyntaxError if the submission doesn't parse.
+    """
+
+    def __init__(self, file_path, source=None):
+        if source is None:
+            with open(file_path) as f:
+                source = f.read()
+        self.file_path = file_path
+        self.source = source
+        self.tree = ast.parse(source, filename=file_path)
+        self.functions = {}
+        for node in self.tree.body:
+            if isinstance(node, ast.FunctionDef):
+                # first definition wins, same as the old per-function lookup
+                self.functions.setdefault(node.name, node)
+        self._graded_tree = None
+        self._analysis_index = None
+
+    def function(self, name):
+        """Top level FunctionDef node called name, or None"""
+        return self.functions.get(name)
+
+    def function_code(self, name):
+        node = self.function(name)
+        if node is None:
+            return None
+        return ast.unparse(node)  # Python 3.9+
+
+    @property
+    def graded_tree(self):
+        """Module node holding only the GRADED_FUNCTIONS this submission defines"""
+        if self._graded_tree is None:
+            body = [self.functions[name] for name in GRADED_FUNCTIONS if name in self.functions]
+            self._graded_tree = ast.Module(body=body, type_ignores=[])
+        return self._graded_tree
+
+    def analysis_index(self):
+        """Facts the "code" and "function" rubric items need, see run_code_checks"""
+        if self._analysis_index is None:
+            self._analysis_index = run_code_checks(self)
+        return self._analysis_index
+
+# Static rubric checks keyed by the RUBRIC "check" name. Every check sees each
+# node of the graded tree once, during a single CheckVisitor walk, so adding a
+# check doesn't add another pass over the tree.
+CODE_CHECKS = {}
+
+def code_check(name):
+    """Class decorator registering a CodeCheck under a RUBRIC "check" name"""
+    def register(cls):
+        CODE_CHECKS[name] = cls
+        return cls
+    return register
+
+class CodeCheck:
+    """Base class for static checks, visit() is called for every node in the tree
+
+    function_stack holds the names of the functions enclosing the node,
+    innermost last.
+    """
+
+    def __init__(self, submission):
+        self.submission = submission
+
+    def visit(self, node, function_stack):
+        pass
+
+    def passed(self):
+        return False
+
+    def report(self):
+        """Optional details written under the grading summary"""
+        return None
+
+class CheckVisitor(ast.NodeVisitor):
+    """Walks a tree once, handing every node to all the registered checks"""
+
+    def __init__(self, checks):
+        self.checks = checks
+        self.functions = set()
+        self.function_stack = []
+
+    def generic_visit(self, node):
+        for check in self.checks:
+            check.visit(node, self.function_stack)
+
+        if isinstance(node, ast.FunctionDef):
+            self.functions.add(node.name)
+            self.function_stack.append(node.name)
+            super().generic_visit(node)
+            self.function_stack.pop()
+        else:
+            super().generic_visit(node)
+
+@code_check("meaningful_vars")
+class MeaningfulVarsCheck(CodeCheck):
+    def __init__(self, submission):
+        super().__init__(submission)
+        self.var_names = set()
+
+    def visit(self, node, function_stack):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            self.var_names.add(node.id)
+
+    def passed(self):
+        return all(len(name) > 2 for name in self.var_names)
+
+# Comment and docstring lines a submission needs for the "comments" rubric item
+MIN_COMMENT_LINES = 3
+
+# Lightweight tokenizer for comments: string literals and comments are matched
+# by the same pattern, whichever starts first, so a '#' inside a string is never
+# taken for a comment. One left-to-right scan, linear in the source size.
+COMMENT_TOKEN_RE = re.compile(
+    r"'''(?:\\[\s\S]|[^\\])*?'''"
+    r'|"""(?:\\[\s\S]|[^\\])*?"""'
+    r"|'(?:\\.|[^'\\\n])*'"
+    r'|"(?:\\.|[^"\\\n])*"'
+    r"|(?P<comment>#[^\n]*)"
+)
+
+def find_comment_rows(source):
+    """Line numbers (1 based) of every line holding a # comment"""
+    rows = set()
+    row = 1
+    last_pos = 0
+    for match in COMMENT_TOKEN_RE.finditer(source):
+        if match.group("comment") is None:
+            continue
+        row += source.count("\n", last_pos, match.start())
+        last_pos = match.start()
+        rows.add(row)
+    return rows
+
+def comment_density(comment_rows, function_spans):
+    """Comment lines per function, function_spans is a list of (first line, last line, name)"""
+    spans = sorted(function_spans)
+    starts = [start for start, _, _ in spans]
+    functions = {name: {"comment_lines": 0, "lines": end - start + 1} for start, end, name in spans}
+    for row in comment_rows:
+        pos = bisect.bisect_right(starts, row) - 1
+        if pos >= 0 and row <= spans[pos][1]:
+            functions[spans[pos][2]]["comment_lines"] += 1
+    for stats in functions.values():
+        stats["density"] = stats["comment_lines"] / stats["lines"]
+    return functions
+
+@code_check("comments")
+class CommentsCheck(CodeCheck):
+    """At least MIN_COMMENT_LINES comment or docstring lines in the submission
+
+    # comments come from one COMMENT_TOKEN_RE scan of the raw source (the AST
+    drops them), docstrings and function spans from the shared visitor walk.
+    """
+
+    def __init__(self, submission):
+        super().__init__(submission)
+        self.comment_rows = find_comment_rows(submission.source)
+        self.function_spans = []
+
+    def visit(self, node, function_stack):
+        if isinstance(node, ast.FunctionDef) and not function_stack:
+            self.function_spans.append((node.lineno, node.end_lineno, node.name))
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            # a string statement on its own is a docstring or block comment
+            self.comment_rows.update(range(node.lineno, node.end_lineno + 1))
+
+    def passed(self):
+        return len(self.comment_rows) >= MIN_COMMENT_LINES
+
+    def report(self):
+        lines = [f"Comment lines: {len(self.comment_rows)}"]
+        for name, stats in comment_density(self.comment_rows, self.function_spans).items():
+            lines.append(f"  {name}: {stats['comment_lines']}/{stats['lines']} lines ({stats['density']:.0%})")
+        return lines
+
+@code_check("loop_validation_roman")
+class RomanLoopCheck(CodeCheck):
+    """A loop used for input validation in show_roman_binary_number()"""
+
+    def __init__(self, submission):
+        super().__init__(submission)
+        self.found_loop = False
+
+    def visit(self, node, function_stack):
+        if "show_roman_binary_number" in function_stack and isinstance(node, (ast.While, ast.For)):
+            self.found_loop = True
+
+    def passed(self):
+        return self.found_loop
+
+@code_check("population_input_validation")
+class PopulationValidationCheck(CodeCheck):
+    """3 while loops validating input in show_population()"""
+
+    def __init__(self, submission):
+        super().__init__(submission)
+        self.while_loops = 0
+
+    def visit(self, node, function_stack):
+        if "show_population" in function_stack and isinstance(node, ast.While):
+            self.while_loops += 1
+
+    def passed(self):
+        return self.while_loops >= 3
+
+class WhileTrueCounter(CodeCheck):
+    """Counts 'while True:' loops, used for the deduction rather than a rubric item"""
+
+    def __init__(self, submission):
+        super().__init__(submission)
+        self.count = 0
+
+    def visit(self, node, function_stack):
+        if isinstance(node, ast.While) and isinstance(node.test, ast.Constant) and node.test.value is True:
+            self.count += 1
+
+# Structural fingerprints: k-grams of normalized node types, winnowed
+FINGERPRINT_K = 5
+WINNOW_WINDOW = 4
+
+class StructureTokens(CodeCheck):
+    """Node types of the graded tree in walk order, identifiers and literal values dropped
+
+    Renaming variables or changing printed text leaves the sequence as it is,
+    which is what the similarity fingerprints are built from.
+    """
+
+    def __init__(self, submission):
+        super().__init__(submission)
+        self.tokens = []
+
+    def visit(self, node, function_stack):
+        if isinstance(node, ast.expr_context):
+            return
+        if isinstance(node, ast.Constant):
+            self.tokens.append(f"Constant:{type(node.value).__name__}")
+        else:
+            self.tokens.append(type(node).__name__)
+
+def winnow(tokens, k=FINGERPRINT_K, window=WINNOW_WINDOW):
+    """Winnowed k-gram hashes of a token sequence, sorted
+
+    crc32 rather than hash(), so every worker process fingerprints alike.
+    """
+    hashes = [zlib.crc32("|".join(tokens[i:i + k]).encode("utf-8")) for i in range(len(tokens) - k + 1)]
+    if len(hashes) <= window:
+        return sorted(set(hashes))
+    return sorted({min(hashes[start:start + window]) for start in range(len(hashes) - window + 1)})
+
+def run_code_checks(submission, check_names=None):
+    """Evaluate static checks in one walk of the submission's graded tree
+
+    By default every registered check runs, not just the ones RUBRIC uses, so
+    a stored trace can be re-scored against a changed rubric without parsing
+    the submission again. Returns a dict with the functions defined, a check
+    name -> passed map, any check reports, the number of 'while True:' loops
+    and the structural fingerprints used by SimilarityIndex.
+    """
+    if check_names is None:
+        check_names = list(CODE_CHECKS)
+    checks = {name: CODE_CHECKS[name](submission) for name in check_names}
+    while_true = WhileTrueCounter(submission)
+    structure = StructureTokens(submission)
+
+    visitor = CheckVisitor(list(checks.values()) + [while_true, structure])
+    visitor.visit(submission.graded_tree)
+    return {
+        "functions": visitor.functions,
+        "checks": {name: check.passed() for name, check in checks.items()},
+        "reports": {name: check.report() for name, check in checks.items() if check.report()},
+        "while_true_count": while_true.count,
+        "fingerprints": winnow(structure.tokens),
+    }
 
-    for node in tree.body:
-        if isinstance(node, ast.FunctionDef) and node.name == func_name:
-            return ast.unparse(node)  # Python 3.9+
+def extract_function_code(submission, func_name):
+    return submission.function_code(func_name)
 
 # Example usage
 
-def extract_all_fns(file_path):
-    try:
-        main_code =  extract_function_code(file_path, "main")
-        
-        show_info_code =  extract_function_code(file_path, "show_student_information")
-
-        roman_binary_code =  extract_function_code(file_path, "show_roman_binary_number")
-
-        population_code = extract_function_code(file_path, "show_population")
-            
-        allCode = []
-        allCode.append(main_code)
-        allCode.append(show_info_code)
-        allCode.append(roman_binary_code)
-        allCode.append(population_code)
-        return allCode
-    except Exception as e:
-        print(f"error in extracting fns in {file_path}, error is : {e}")
-        return None
+def extract_all_fns(submission):
+    return [extract_function_code(submission, name) for name in GRADED_FUNCTIONS]
 
 def print_ast(code_str) -> None:
     for s in code_str:
@@ -120,29 +441,23 @@ def print_ast(code_str) -> None:
             print("~" * 50)
         print(str(s))
 
-def create_virtual_module_from_strings(name, function_strings):
-    """Create a virtual module-like object from a list of function strings (without execution)."""
-    try:
-        for index in range(len(function_strings)):
-            fn = function_strings[index]
-            print(f"fn number {index + 1} is : \n {fn}")
-        source_code = "\n\n\n".join(function_strings)
-        tree = ast.parse(source_code)
-
-        # Create a dummy module object
-        module = types.SimpleNamespace()
-        module.__name__ = name
-        module.__source__ = source_code
-        module.__ast__ = tree
-        module.__functions__ = [
-            node for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)
-        ]
-        return module
-        # Optionally store in sys.modules if needed (disabled by default)
-        # sys.modules[name] = module
-    except Exception as e:
-        print(e)
-    return None
+def create_virtual_module(name, submission):
+    """Create a virtual module-like object from a parsed submission (without execution)."""
+    # The sources are only unparsed when debug logging is on
+    for index, fn_name in enumerate(GRADED_FUNCTIONS):
+        log.debug("fn number %d is : \n %s", index + 1, LazyText(lambda fn_name=fn_name: submission.function_code(fn_name) or ""))
+
+    # Create a dummy module object
+    module = types.SimpleNamespace()
+    module.__name__ = name
+    module.__ast__ = submission.graded_tree
+    module.__functions__ = [
+        node for node in module.__ast__.body if isinstance(node, ast.FunctionDef)
+    ]
+    module.__submission__ = submission
+    return module
+    # Optionally store in sys.modules if needed (disabled by default)
+    # sys.modules[name] = module
 
 def extract_using_ast(file_path):
     with open(file_path) as f:
@@ -158,12 +473,175 @@ class TimeoutException(Exception):
 def timeout_handler(signum, frame):
     raise TimeoutException("Program execution timed out")
 
-def load_input_prompts():
+def load_input_prompts(base_dir='.'):
     """Load input prompts from input.txt"""
-    with open('input.txt', 'r') as f:
+    with open(os.path.join(base_dir, 'input.txt'), 'r') as f:
         return [line.strip() for line in f.readlines()]
 
-def import_student_module(file_path):
+# A number as students print it: optional sign, digits, optional decimals
+NUMBER_RE = re.compile(r"(?<![\d.])-?\d+(?:\.\d+)?")
+
+class OutputMatcher:
+    """Every output expectation of a rubric or scenario, compiled once
+
+    expectations maps a key to one of {"literal": text}, {"regex": pattern}
+    or {"number": value, "tolerance": t}. Literals are plain substring
+    checks, every regex is compiled on its own (so flags, backreferences and
+    group names work as written) and numbers go into a sorted table that the
+    numbers found in the output are looked up in. matches() joins the
+    captured output once and returns the keys that matched.
+    """
+
+    def __init__(self, expectations):
+        self.literals = {}
+        self.regexes = {}
+        self.numbers = []
+        for key, expectation in expectations.items():
+            if "literal" in expectation:
+                self.literals[key] = expectation["literal"]
+            elif "regex" in expectation:
+                self.regexes[key] = re.compile(expectation["regex"], re.MULTILINE)
+            elif "number" in expectation:
+                value = float(expectation["number"])
+                tolerance = float(expectation.get("tolerance", 0))
+                self.numbers.append((value - tolerance, value + tolerance, key))
+            else:
+                raise ValueError(f"{key}: an expectation needs a literal, regex or number")
+        self.numbers.sort()
+        self.number_lows = [low for low, _, _ in self.numbers]
+        self.number_keys = {key for _, _, key in self.numbers}
+        self.integer_parts_re = self._integer_parts_re()
+
+    def _integer_parts_re(self, max_integer_parts=32):
+        """Regex for the integer digits a number in the table can have, None if there are too many
+
+        Searching for those digits is far cheaper than parsing every number
+        in the output, numbers_in then checks each hit is a whole number.
+        """
+        integer_parts = set()
+        for low, high, _ in self.numbers:
+            smallest, largest = sorted((int(abs(low)), int(abs(high))))
+            if low <= 0 <= high:
+                smallest = 0
+            if largest - smallest + len(integer_parts) > max_integer_parts:
+                return None
+            integer_parts.update(str(part) for part in range(smallest, largest + 1))
+        return re.compile("(?:" + "|".join(sorted(integer_parts)) + r")(?!\d)")
+
+    def numbers_in(self, text):
+        """The numbers NUMBER_RE finds in text, skipping those the table can't match"""
+        if self.integer_parts_re is None:
+            for match in NUMBER_RE.finditer(text):
+                yield float(match.group())
+            return
+        for hit in self.integer_parts_re.finditer(text):
+            # Back up over leading zeros and a sign to where NUMBER_RE would start
+            start = hit.start()
+            while start and text[start - 1] == "0":
+                start -= 1
+            match = None
+            if start and text[start - 1] == "-":
+                match = NUMBER_RE.match(text, start - 1)
+            if match is None:
+                match = NUMBER_RE.match(text, start)
+            if match is not None:
+                yield float(match.group())
+
+    def matches(self, captured_lines):
+        """Keys of the expectations found in the captured output lines"""
+        text = "\n".join(captured_lines)
+        found = {key for key, literal in self.literals.items() if literal in text}
+        found.update(key for key, regex in self.regexes.items() if regex.search(text))
+
+        if self.numbers:
+            missing = set(self.number_keys)
+            for number in self.numbers_in(text):
+                for low, high, key in self.numbers[:bisect.bisect_right(self.number_lows, number)]:
+                    if number <= high:
+                        missing.discard(key)
+                if not missing:
+                    break
+            found |= self.number_keys - missing
+        return found
+
+TEST_CASES_FILE = "testcases.json"
+
+def compile_scenario(scenario, where):
+    """Validate one scenario from the test case file and compile its expected patterns"""
+    if not isinstance(scenario, dict) or not isinstance(scenario.get("inputs"), list):
+        raise ValueError(f"{where}: a scenario needs a list of \"inputs\"")
+    name = scenario.get("name") or where
+    expect = list(scenario.get("expect", []))
+    try:
+        matcher = OutputMatcher({pattern: {"regex": pattern} for pattern in expect})
+    except re.error as e:
+        raise ValueError(f"{where}: bad expected output pattern: {e}")
+    return {"name": name, "inputs": [str(value) for value in scenario["inputs"]], "expect": expect, "matcher": matcher}
+
+def load_test_plan(base_dir='.', path=None):
+    """Load the declarative test cases once, returns the compiled test plan
+
+    The test case file lists named input scenarios per graded function, each
+    with the output patterns (regular expressions) it is expected to print:
+
+        {"default": [{"name": ..., "inputs": [...]}],
+         "functions": {"main": [{"name": ..., "inputs": [...], "expect": [...]}]}}
+
+    A function without its own scenarios runs the "default" ones. Without a
+    test case file every function gets one scenario with the input.txt lines.
+    The plan is built once at startup and only read afterwards (see
+    set_test_plan), so it can be shared with every worker.
+    """
+    if path is None:
+        path = os.path.join(base_dir, TEST_CASES_FILE)
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            spec = json.load(f)
+    else:
+        spec = {"default": [{"name": "input.txt", "inputs": load_input_prompts(base_dir)}], "functions": {}}
+
+    default = [compile_scenario(scenario, f"default[{i}]") for i, scenario in enumerate(spec.get("default", []))]
+    functions = {}
+    for function_name, scenarios in spec.get("functions", {}).items():
+        functions[function_name] = [compile_scenario(scenario, f"{function_name}[{i}]")
+                                    for i, scenario in enumerate(scenarios)]
+    return {
+        "default": default,
+        "functions": functions,
+        # Normalized reference transcripts per "function/scenario", see attach_reference
+        "golden": {},
+        # What the cache key covers, any change to the test cases re-runs the submissions
+        "fingerprint": json.dumps(spec, sort_keys=True),
+    }
+
+_test_plan = None
+
+def set_test_plan(test_plan):
+    """Install the test plan for this process, also the --jobs pool initializer"""
+    global _test_plan
+    _test_plan = test_plan
+
+def init_grading_worker(test_plan, log_level):
+    """--jobs pool initializer: the startup test plan and log level for this worker"""
+    set_test_plan(test_plan)
+    setup_logging(next(name for name, level in LOG_LEVELS.items() if level == log_level))
+
+def get_test_plan(base_dir='.'):
+    """The test plan loaded at startup, loading it now if nobody did"""
+    if _test_plan is None:
+        set_test_plan(load_test_plan(base_dir))
+    return _test_plan
+
+def scenarios_for(test_plan, function_name):
+    """The scenarios a graded function is run with"""
+    return test_plan["functions"].get(function_name, test_plan["default"])
+
+def check_expectations(scenario, captured_lines):
+    """Which of a scenario's expected output patterns the captured output matched"""
+    found = scenario["matcher"].matches(captured_lines)
+    return {pattern: pattern in found for pattern in scenario["expect"]}
+
+def import_student_module(file_path, source=None):
     #! old code
     """Dynamically import a Python file"""
     #spec = importlib.util.spec_from_file_location("student_module", file_path)
@@ -172,241 +650,642 @@ def import_student_module(file_path):
     #spec.loader.exec_module(module)
     #return module
     
-    res =  extract_all_fns(file_path)    
-    if res is not None:
-        main_code = ""
-        stu_info_code = ""
-        binary_code = ""
-        pop_code = ""
-
-        inside_main = False
-        inside_stu = False
-        inside_binary = False
-        inside_pop = False
-
-        for index in range(len(res)):
-            s = res[index]
-            if s is None:
-                continue
-
-            if "def" in s:
-                if "main" in s:
-                    main_code += s
-                    inside_main = True
-                    inside_stu = False
-                    inside_binary = False
-                    inside_pop = False
-                    continue
-
-                elif "student" in s:
-                    stu_info_code += s
-                    inside_main = False
-                    inside_stu = True
-                    inside_binary = False
-                    inside_pop = False
-                    continue
-                elif "binary" in s:
-                    binary_code += s
-                    inside_main = False
-                    inside_stu = False
-                    inside_binary = True
-                    inside_pop = False
-                    continue
-                elif "population" in s:
-                    pop_code += s
-                    inside_main = False
-                    inside_stu = False
-                    inside_binary = False
-                    inside_pop = True
-                    continue
-
-            if inside_main:
-                main_code += s
-            elif inside_stu:
-                stu_info_code += s
-            elif inside_binary:
-                binary_code += s
-            elif inside_pop:
-                pop_code += s
-
-        print(f"maincode str is \n {main_code}")
-        print('-' * 50 )
-        print(f"stuinfo str is \n {stu_info_code}")
-        print('-' * 50 )
-        print(f"binary_code str is \n {binary_code}")
-        print('-' * 50 )
-        print(f"pop_code str is \n {pop_code}")
-        print('-' * 50 )
-        return create_virtual_module_from_strings("main",[main_code, stu_info_code, binary_code, pop_code])
-    else:
-        print("error in import_student_module")
+    try:
+        submission = SubmissionAST(file_path, source)
+    except Exception as e:
+        log.warning("error in extracting fns in %s, error is : %s", file_path, e)
         return None
 
+    for label, fn_name in zip(("maincode", "stuinfo", "binary_code", "pop_code"), GRADED_FUNCTIONS):
+        log.debug("%s str is \n %s\n%s", label, LazyText(lambda fn_name=fn_name: submission.function_code(fn_name) or ""), '-' * 50)
+    return create_virtual_module("main", submission)
+
 
-def create_project_folder(project_name):
+def project_folder(project_file, base_dir='.'):
+    """The folder a submission's results go in: its file name without .py, inside base_dir"""
+    return os.path.join(base_dir, os.path.splitext(os.path.basename(project_file))[0])
+
+def create_project_folder(project_file, base_dir='.'):
     """Create a folder for the project if it doesn't exist"""
-    folder_name = project_name.replace('.py', '')
+    folder_name = project_folder(project_file, base_dir)
     if not os.path.exists(folder_name):
         os.makedirs(folder_name)
     return folder_name
 
-def run_with_timeout(func, args=(), timeout_duration=10):
-    """Run a function with a timeout"""
-    result = []
-    error = []
-
-    def target():
-        try:
-            result.append(func(*args))
-        except Exception as e:
-            error.append(str(e))
-            error.append(traceback.format_exc())
-
-    thread = threading.Thread(target=target)
-    thread.daemon = True
-    thread.start()
-    thread.join(timeout_duration)
-
-    if thread.is_alive():
-        return None, ["Program execution timed out after {} seconds".format(timeout_duration)]
-    
-    if error:
-        return None, error
-        
-    return result[0] if result else None, None
+# Hard limits for student code running in a sandbox worker process
+SANDBOX_LIMITS = {
+    "wall_seconds": 10,
+    "cpu_seconds": 5,
+    "memory_bytes": 512 * 1024 * 1024,
+    # Output kept per call, a function printing more than this is stopped
+    "output_lines": 2000,
+    "output_chars": 200_000,
+    # '9' answers given once the scripted inputs run out, after that the call is stopped
+    "fallback_inputs": 20,
+}
+
+def function_call_result(name, captured_lines, inputs_consumed, outcome, error=None, output_truncated=False,
+                         fallback_inputs=0):
+    """Record of one student function call, as stored in the trace"""
+    return {
+        "function": name,
+        "captured_lines": captured_lines,
+        "inputs_consumed": inputs_consumed,
+        "fallback_inputs": fallback_inputs,
+        "outcome": outcome,
+        "error": error,
+        "output_truncated": output_truncated,
+    }
 
-import os
-import time
-import shutil
-import traceback
-import contextlib
-import builtins
-from io import StringIO
-def capture_output_and_files(module, input_prompts, folder_name, project_file):
-    source_code_raw = []
-    with open(project_file, 'r') as file:
-        source_code_raw = file.readlines()
-    captured_lines = []
+class InputExhausted(BaseException):
+    """Raised into student code that keeps asking for input after the fallback answers ran out
+
+    A BaseException for the same reason as OutputLimitExceeded.
+    """
+
+class OutputLimitExceeded(BaseException):
+    """Raised into student code once its output goes past the OutputSink limits
+
+    A BaseException, so the student's own `except Exception` can't swallow it.
+    """
+
+class OutputSink:
+    """Capped stdout replacement for one student function call
+
+    Printed text is buffered until the next input() prompt (or the end of the
+    call) and then split into lines. Once the call has written more than
+    max_lines lines or max_chars characters the rest is dropped, truncated is
+    set and every further write or input raises OutputLimitExceeded, so a
+    runaway print loop ends right away instead of filling memory.
+    """
+
+    def __init__(self, max_lines, max_chars):
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.lines = []
+        self.pending = []
+        self.pending_newlines = 0
+        self.chars = 0
+        self.truncated = False
+
+    def _reserve(self, text, newlines):
+        if self.truncated:
+            raise OutputLimitExceeded("output limit already reached")
+        self.chars += len(text)
+        if self.chars > self.max_chars or len(self.lines) + self.pending_newlines + newlines >= self.max_lines:
+            self.truncated = True
+            raise OutputLimitExceeded(f"more than {self.max_lines} lines or {self.max_chars} characters of output")
+
+    def write(self, text):
+        newlines = text.count('\n')
+        self._reserve(text, newlines)
+        self.pending.append(text)
+        self.pending_newlines += newlines
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def flush_lines(self):
+        """Move the buffered text into lines"""
+        if self.pending:
+            self.lines.extend(''.join(self.pending).splitlines())
+            self.pending = []
+            self.pending_newlines = 0
+
+    def add_line(self, line):
+        """Record a whole line (an input prompt or answer), counted against the limits"""
+        self.flush_lines()
+        self._reserve(line, 1)
+        self.lines.append(line)
+
+def student_builtins(cwd):
+    """A private copy of the builtins for a submission's namespace
+
+    Student code gets this as exec_globals['__builtins__'], and
+    run_student_function swaps its own input/print/open into it for every
+    call. The real builtins module is never touched. open resolves relative
+    paths against cwd, the submission's scratch dir.
+    """
+    namespace_builtins = dict(builtins.__dict__)
+
+    def student_open(file, *args, **kwargs):
+        if isinstance(file, (str, bytes, os.PathLike)) and not os.path.isabs(file):
+            file = os.path.join(os.fsencode(cwd) if isinstance(file, bytes) else cwd, file)
+        return builtins.open(file, *args, **kwargs)
+
+    namespace_builtins["open"] = student_open
+    return namespace_builtins
+
+def run_student_function(func, name, input_prompts, namespace_builtins, limits=None):
+    """Call one student function with scripted input, returns a function_call_result
+
+    outcome is "completed", "exited" (the student called exit()), "error",
+    "output_limit" (it printed past limits["output_lines"/"output_chars"]) or
+    "input_exhausted". Once input_prompts are used up input() answers '9'
+    limits["fallback_inputs"] more times, a menu that doesn't exit on 9 is
+    then stopped instead of spinning until the wall clock timeout.
+    input and print are replaced in namespace_builtins (see student_builtins)
+    for the length of the call, every call gets fresh shims. sys.stdout and
+    sys.stderr point at the call's capped sink too, so direct writes are
+    captured and limited like prints. That is process-wide, which is fine
+    because this only runs inside a sandbox worker, one call at a time.
+    """
+    if limits is None:
+        limits = SANDBOX_LIMITS
+    sink = OutputSink(limits["output_lines"], limits["output_chars"])
     input_idx = 0
-    stdout_buffer = StringIO()
-    initial_txt_files = set(f for f in os.listdir('.') if f.endswith('.txt'))
+    fallback_inputs = 0
+    exhausted = False
 
     def mock_input(prompt=''):
-        nonlocal input_idx, current_function_name
-        stdout_content = stdout_buffer.getvalue()
-        if stdout_content:
-            captured_lines.extend(stdout_content.splitlines())
-            stdout_buffer.seek(0)
-            stdout_buffer.truncate()
-
+        nonlocal input_idx, fallback_inputs, exhausted
+        sink.flush_lines()
         if prompt:
-            captured_lines.append(prompt.rstrip())
-        func_inputs = input_prompts_indiv.get(current_function_name, input_prompts_indiv.get("__global__", []))
+            sink.add_line(prompt.rstrip())
 
         if input_idx < len(input_prompts):
             value = input_prompts[input_idx]
-            captured_lines.append(value)
+            sink.add_line(value)
             input_idx += 1
             return value
+        if fallback_inputs >= limits["fallback_inputs"]:
+            exhausted = True
+            raise InputExhausted(f"still asking for input after {fallback_inputs} fallback answers")
+        fallback_inputs += 1
         return '9'
 
-    original_input = builtins.input
-    builtins.input = mock_input
+    def mock_print(*args, sep=' ', end='\n', file=None, flush=False):
+        if file is None or file is sys.stdout:
+            file = sink
+        builtins.print(*args, sep=sep, end=end, file=file, flush=flush)
 
-    final_grade = 100
-    deductions = []
-    awarded_points = []
-    functions_in_ast = set()
-    var_names = set()
-    comment_lines = 0
-    loop_validations = {"roman": False, "population_inputs": 0}
-    while_true_count = 0
-    
-    input_prompts_indiv =  {
-    "main": ["1", "2", "a", "3", "10", "2.3", " ", "9"],
-    "show_roman_binary_number": ["6"],
-    "show_population": ["2", "30", "10"],
-    "__global__": ["9"]  # fallback input list
+    outcome = "completed"
+    error = None
+    namespace_builtins["input"] = mock_input
+    namespace_builtins["print"] = mock_print
+    try:
+        with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+            func()
+    except SystemExit:
+        # exit() from the student's menu ends their program, not the grader
+        outcome = "exited"
+    except OutputLimitExceeded:
+        pass  # recorded below, the student may also have caught it themselves
+    except InputExhausted:
+        pass
+    except Exception as e:
+        outcome = "error"
+        error = f"{type(e).__name__}: {str(e)}"
+        sink.flush_lines()
+        sink.lines.append(f"Error running {name}: {str(e)}")
+        sink.lines.append(traceback.format_exc())
+
+    sink.flush_lines()
+    captured_lines = sink.lines
+    if sink.truncated:
+        outcome = "output_limit"
+        error = "Output truncated after {} lines or {} characters".format(limits["output_lines"], limits["output_chars"])
+        captured_lines.append(f"Error running {name}: {error}")
+    elif exhausted and outcome != "exited":
+        # checked after the call, the student may have caught InputExhausted
+        outcome = "input_exhausted"
+        error = "Kept asking for input after the scripted inputs and {} fallback answers".format(limits["fallback_inputs"])
+        captured_lines.append(f"Error running {name}: {error}")
+    return function_call_result(name, captured_lines, input_idx, outcome, error, sink.truncated, fallback_inputs)
+
+def apply_memory_limit(limits):
+    """Cap the address space of the current process"""
+    resource.setrlimit(resource.RLIMIT_AS, (limits["memory_bytes"], limits["memory_bytes"]))
+
+def apply_cpu_limit(limits):
+    """Allow the current process limits["cpu_seconds"] more CPU time from now on
+
+    RLIMIT_CPU counts the whole life of the process, so a reused worker moves
+    the soft limit forward before every job. Going past it raises SIGXCPU,
+    which kills the worker.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(used) + 1 + limits["cpu_seconds"]
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+def _sandbox_worker_main(conn, limits):
+    """Job loop of a pre-forked sandbox worker
+
+    Every job is (marshalled code, calls, cwd) where calls is a list of
+    (function name, input prompts). The code is exec'd once into a fresh
+    namespace and every call reuses those definitions, each with its own
+    input and stdout shims. One result is sent back per call as soon as it
+    finishes, so the parent keeps what completed if a later call hangs. A
+    None job ends the worker. Ctrl-C is left to the parent, which stops its
+    workers through SandboxPool.close.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    apply_memory_limit(limits)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        code_bytes, calls, cwd = job
+        namespace_builtins = student_builtins(cwd)
+        namespace = {"__name__": "__student__", "__builtins__": namespace_builtins}
+        setup_error = None
+        try:
+            apply_cpu_limit(limits)
+            os.chdir(cwd)  # for student code that uses os.path directly
+            exec(marshal.loads(code_bytes), namespace)
+        except BaseException as e:
+            setup_error = e
+        for index, (name, input_prompts) in enumerate(calls):
+            try:
+                if setup_error is not None:
+                    raise setup_error
+                apply_cpu_limit(limits)
+                started = time.perf_counter()
+                result = run_student_function(namespace[name], name, input_prompts, namespace_builtins, limits)
+                result["seconds"] = round(time.perf_counter() - started, 6)
+                result["worker_peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                if index == len(calls) - 1:
+                    # Finalize file objects the student never closed so their writes
+                    # hit the disk before the parent collects the files
+                    namespace.clear()
+                gc.collect()
+            except BaseException as e:
+                result = function_call_result(name, [f"Error running {name}: {str(e)}"], None, "error", f"{type(e).__name__}: {str(e)}")
+            conn.send(result)
+    conn.close()
+
+class SandboxWorker:
+    """Handle on one pre-forked worker process and its end of the pipe"""
+
+    def __init__(self, limits, start_method="fork"):
+        context = multiprocessing.get_context(start_method)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_sandbox_worker_main, args=(child_conn, limits), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def kill(self):
+        self.conn.close()
+        # give a worker that already died, or is exiting on the closed pipe, a moment to be reaped
+        self.process.join(0.1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+            self.process.join(1)
+        except OSError:
+            pass
+        self.kill()
+
+class SandboxPool:
+    """Warm worker processes that run student functions under SANDBOX_LIMITS
+
+    Forking a worker once and feeding it jobs over a pipe keeps process
+    isolation without paying for a new process per function call. A worker
+    is thrown away and replaced after max_jobs jobs, on a timeout, or when
+    it dies (CPU limit, memory limit, crash). start_method is the
+    multiprocessing start method workers are created with.
+    """
+
+    def __init__(self, limits=None, max_jobs=50, start_method="fork"):
+        self.limits = limits if limits is not None else SANDBOX_LIMITS
+        self.max_jobs = max_jobs
+        self.start_method = start_method
+        self.idle = []
+        self.lock = threading.Lock()
+        # Workers and their pipes belong to the process that forked them
+        self.pid = os.getpid()
+
+    def run(self, code, calls, cwd):
+        """Run calls, a list of (function name, input prompts), against one code object
+
+        The code is exec'd once per worker and every call reuses its
+        definitions. Returns one function_call_result per call, in order. A
+        call whose worker is killed or dies gets an outcome of "timeout",
+        "cpu_limit" or "terminated", and the calls after it are sent to a
+        fresh worker.
+        """
+        code_bytes = marshal.dumps(code)
+        results = []
+        while len(results) < len(calls):
+            pending = calls[len(results):]
+            with self.lock:
+                worker = self.idle.pop() if self.idle else None
+            if worker is None:
+                worker = SandboxWorker(self.limits, self.start_method)
+
+            failed_call = None
+            try:
+                worker.conn.send((code_bytes, pending, cwd))
+            except OSError:
+                failed_call = pending[0][0]
+            if failed_call is None:
+                for name, _ in pending:
+                    result = None
+                    try:
+                        if worker.conn.poll(self.limits["wall_seconds"]):
+                            result = worker.conn.recv()
+                    except (EOFError, OSError):
+                        pass  # worker died before it could report
+                    if result is None:
+                        failed_call = name
+                        break
+                    results.append(result)
+            worker.jobs += 1
+
+            if failed_call is not None or worker.jobs >= self.max_jobs:
+                # a worker that didn't answer is stuck or dead, it is never reused
+                worker.kill()
+            else:
+                with self.lock:
+                    self.idle.append(worker)
+            if failed_call is not None:
+                results.append(self._failure_result(worker, failed_call))
+        return results
+
+    def _failure_result(self, worker, name):
+        """function_call_result for a call whose worker was killed or died"""
+        if worker.process.exitcode == -signal.SIGKILL:
+            outcome = "timeout"
+            reason = "Program execution timed out after {} seconds".format(self.limits["wall_seconds"])
+        elif worker.process.exitcode == -signal.SIGXCPU:
+            outcome = "cpu_limit"
+            reason = "Program exceeded the CPU time limit of {} seconds".format(self.limits["cpu_seconds"])
+        else:
+            outcome = "terminated"
+            reason = f"Program was terminated (exit code {worker.process.exitcode})"
+        return function_call_result(name, [f"Error running {name}: {reason}"], None, outcome, reason)
+
+    def prestart(self, count):
+        """Start idle workers up to count now, so the first jobs don't wait for them"""
+        with self.lock:
+            missing = count - len(self.idle)
+        workers = [SandboxWorker(self.limits, self.start_method) for _ in range(missing)]
+        with self.lock:
+            self.idle.extend(workers)
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.stop()
+
+    def forget(self):
+        """Drop workers inherited over a fork without touching them, they belong to the parent"""
+        for worker in self.idle:
+            worker.conn.close()
+        self.idle = []
+
+# One pool per grading process, created on first use (--jobs workers each get their own)
+_sandbox_pool = None
+_sandbox_pool_lock = threading.Lock()
+# "fork" is cheapest, but a process running grading threads switches to "forkserver":
+# forking a multithreaded process can copy a lock some other thread holds
+_sandbox_start_method = "fork"
+
+def get_sandbox_pool():
+    global _sandbox_pool
+    with _sandbox_pool_lock:
+        if _sandbox_pool is None or _sandbox_pool.pid != os.getpid():
+            _sandbox_pool = SandboxPool(start_method=_sandbox_start_method)
+            atexit.register(_sandbox_pool.close)
+    return _sandbox_pool
+
+def set_sandbox_start_method(start_method):
+    """Create sandbox workers with start_method from now on, a pool using another one is closed"""
+    global _sandbox_start_method
+    _sandbox_start_method = start_method
+    if _sandbox_pool is not None and _sandbox_pool.start_method != start_method:
+        close_sandbox_pool()
+
+def close_sandbox_pool():
+    """Stop this process's sandbox workers, the next get_sandbox_pool starts fresh ones"""
+    global _sandbox_pool
+    with _sandbox_pool_lock:
+        pool, _sandbox_pool = _sandbox_pool, None
+    if pool is not None:
+        pool.close()
+
+def _forget_sandbox_pool_after_fork():
+    """A forked child (a --jobs grading process) must never share the parent's sandbox workers"""
+    global _sandbox_pool, _sandbox_pool_lock
+    _sandbox_pool_lock = threading.Lock()
+    if _sandbox_pool is not None:
+        _sandbox_pool.forget()
+        _sandbox_pool = None
+
+os.register_at_fork(after_in_child=_forget_sandbox_pool_after_fork)
+
+import os
+import time
+import shutil
+import traceback
+import contextlib
+import builtins
+from io import StringIO
+class PhaseTimer:
+    """Wall clock seconds spent in each grading phase of one submission"""
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - started
+
+    def timings(self, calls=()):
+        """Phase durations and peak memory, as stored in trace.json and the grading_result
+
+        The sandbox peak is the largest the workers that ran calls had grown
+        to, the grader peak is this grading process's own.
+        """
+        return {
+            "phases": {name: round(seconds, 6) for name, seconds in self.seconds.items()},
+            "total": round(sum(self.seconds.values()), 6),
+            "grader_peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "sandbox_peak_rss_kb": max((call.get("worker_peak_rss_kb") or 0 for call in calls), default=0),
+        }
+
+def analyze_submission(module, source):
+    """Static analysis facts for a trace, from the submission's single parse"""
+    if module is None:
+        # The submission didn't parse: run the checks over an empty tree so the
+        # ones that only look at the raw text are still evaluated
+        unparsed = types.SimpleNamespace(source=source, graded_tree=ast.Module(body=[], type_ignores=[]))
+        analysis = run_code_checks(unparsed)
+    else:
+        analysis = module.__submission__.analysis_index()
+    return {
+        "functions": sorted(analysis["functions"]),
+        "checks": analysis["checks"],
+        "reports": analysis["reports"],
+        "while_true_count": analysis["while_true_count"],
+        "fingerprints": analysis["fingerprints"],
     }
 
+def execute_submission(module, test_plan, folder_name, scratch_dir, timer=None):
+    """Run the student's functions in the sandbox, once per test plan scenario
+
+    Files the submission wrote are moved from scratch_dir into folder_name.
+    Returns (captured output lines, function_call_result per call, names of
+    the files written).
+    """
+    if timer is None:
+        timer = PhaseTimer()
+    captured_lines = []
+    calls = []
+    files_written = []
     try:
-        with contextlib.redirect_stdout(stdout_buffer):
-            source_code = module.__source__
-
-            # Parse source to AST
-            tree = ast.parse(source_code)
-
-            # Analyze AST
-            for node in ast.walk(tree):
-                if isinstance(node, ast.FunctionDef):
-                    functions_in_ast.add(node.name)
-
-                    # Check for loops inside roman validation
-                    if node.name == "show_roman_binary_number":
-                        for subnode in ast.walk(node):
-                            if isinstance(subnode, ast.While) or isinstance(subnode, ast.For):
-                                loop_validations["roman"] = True
-
-                    # Check for 3 validations in show_population
-                    if node.name == "show_population":
-                        for subnode in ast.walk(node):
-                            if isinstance(subnode, ast.While):
-                                loop_validations["population_inputs"] += 1
-
-                if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
-                    var_names.add(node.id)
-
-                if isinstance(node, ast.While):
-                    # Check for while True specifically
-                    if isinstance(node.test, ast.Constant) and node.test.value is True:
-                        while_true_count += 1
-
-            # Count comments in the source
-            comment_lines = sum(1 for line in source_code.splitlines() if line.strip().startswith("#"))
-
-            # Compile and execute code
-            exec_globals = {}
-            compiled_code = compile(source_code, filename="<student_code>", mode="exec")
-            exec(compiled_code, exec_globals)
-
-            for name, obj in exec_globals.items():
-                if callable(obj) and not name.startswith("__"):
-                    print(f"Running function: {name}")
-                    current_function_name = name
-                    input_idx = 0
-                    try:
-                        stdout_buffer.seek(0)
-                        stdout_buffer.truncate()
-                        with contextlib.redirect_stdout(stdout_buffer):
-                            result = obj()
-                    except Exception as e:
-                        captured_lines.append(f"Error running {name}: {str(e)}")
-                        captured_lines.append(traceback.format_exc())
-                        
-                    stdout_content = stdout_buffer.getvalue()
-                    if stdout_content:
-                        captured_lines.extend(stdout_content.splitlines())
-                    
+        # Compile once here, a sandbox worker execs it once and runs every
+        # (function, scenario) pair against the same definitions
+        with timer.phase("compile"):
+            compiled_code = compile(module.__ast__, filename="<student_code>", mode="exec")
+        planned = [(function.name, scenario) for function in module.__functions__
+                   for scenario in scenarios_for(test_plan, function.name)]
+        with timer.phase("sandbox"):
+            results = get_sandbox_pool().run(compiled_code, [(name, scenario["inputs"]) for name, scenario in planned], scratch_dir)
+        for (name, scenario), call in zip(planned, results):
+            call["scenario"] = scenario["name"]
+            call["expectations"] = check_expectations(scenario, call["captured_lines"])
+            golden = test_plan["golden"].get(f"{name}/{scenario['name']}")
+            if golden is not None:
+                call["similarity"] = transcript_similarity(golden, call["captured_lines"])
+            captured_lines.extend(call["captured_lines"])
+            calls.append(call)
 
     except Exception as e:
         captured_lines.append(f"Execution error: {str(e)}")
         captured_lines.append(traceback.format_exc())
 
     finally:
-        builtins.input = original_input
         try:
-            time.sleep(1)
-            current_txt_files = set(f for f in os.listdir('.') if f.endswith('.txt'))
-            new_txt_files = current_txt_files - initial_txt_files - {'input.txt'}
-            for txt_file in new_txt_files:
-                shutil.move(txt_file, os.path.join(folder_name, txt_file))
+            # Student code runs inside scratch_dir, so everything in it was written by
+            # the submission (the sandbox worker flushed its files after each call)
+            with timer.phase("move_files"):
+                for written_file in sorted(os.listdir(scratch_dir)):
+                    shutil.move(os.path.join(scratch_dir, written_file), os.path.join(folder_name, written_file))
+                    files_written.append(written_file)
         except Exception as e:
             captured_lines.append(f"File handling error: {str(e)}")
 
-    
+    return captured_lines, calls, files_written
+
+def capture_output_and_files(module, test_plan, folder_name, scratch_dir, source, timer=None):
+    """Execute and analyze one submission, returns its trace
+
+    The trace holds everything scoring needs so the submission can be scored
+    again without running the student's code: the captured output, every
+    function call (scenario, inputs consumed, outcome, exception, expected
+    patterns matched), the files written,
+    the static analysis and the source.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+    captured_lines, calls, files_written = execute_submission(module, test_plan, folder_name, scratch_dir, timer)
+    with timer.phase("analyze"):
+        analysis = analyze_submission(module, source)
+    return {
+        "captured_lines": captured_lines,
+        "calls": calls,
+        "files_written": files_written,
+        "analysis": analysis,
+        "source": source,
+    }
+
+def normalize_transcript(captured_lines):
+    """Lines compared against the reference: case and spacing folded, blank lines dropped"""
+    return [" ".join(line.split()).casefold() for line in captured_lines if line.strip()]
+
+def transcript_similarity(golden, captured_lines):
+    """Line diff ratio (0 to 1) of a call's output against the normalized reference transcript"""
+    matcher = difflib.SequenceMatcher(None, golden, normalize_transcript(captured_lines), autojunk=False)
+    return round(matcher.ratio(), 4)
+
+def attach_reference(test_plan, reference_path):
+    """Run a reference solution once per scenario and add its golden transcripts to test_plan
+
+    This runs at startup before any submission is graded. The reference goes
+    through the same sandbox as the students, the normalized transcripts are
+    kept in test_plan["golden"] and shared with every worker, so no
+    reference run ever happens per student. The fingerprint changes with the
+    transcripts, so cached traces are compared again after the reference
+    changes.
+    """
+    with open(reference_path, "r") as f:
+        source = f.read()
+    module = import_student_module(reference_path, source)
+    if module is None:
+        raise ValueError(f"reference solution {reference_path} could not be parsed")
+    scratch_dir = tempfile.mkdtemp(prefix="grader_reference_")
+    try:
+        compiled_code = compile(module.__ast__, filename="<reference>", mode="exec")
+        planned = [(function.name, scenario) for function in module.__functions__
+                   for scenario in scenarios_for(test_plan, function.name)]
+        results = get_sandbox_pool().run(compiled_code, [(name, scenario["inputs"]) for name, scenario in planned], scratch_dir)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    golden = {}
+    for (name, scenario), call in zip(planned, results):
+        if call["outcome"] not in ("completed", "exited"):
+            log.warning("Reference %s [%s] ended with %s: %s", name, scenario["name"], call["outcome"], call["error"])
+        golden[f"{name}/{scenario['name']}"] = normalize_transcript(call["captured_lines"])
+    log.info("Reference solution %s: %d golden transcripts", reference_path, len(golden))
+    golden_digest = hashlib.sha256(json.dumps(golden, sort_keys=True).encode("utf-8")).hexdigest()
+    return dict(test_plan, golden=golden, fingerprint=test_plan["fingerprint"] + golden_digest)
+
+def rubric_version(rubric):
+    """Short hash of a rubric, scores are cached per rubric version"""
+    return hashlib.sha256(json.dumps(rubric, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+# OutputMatcher per rubric version, built the first time a rubric scores a trace
+_output_matchers = {}
+
+def rubric_output_matcher(rubric):
+    """The compiled matcher for the "match" expectations of a rubric's output rules, keyed by rule index"""
+    version = rubric_version(rubric)
+    if version not in _output_matchers:
+        _output_matchers[version] = OutputMatcher({index: rule["match"] for index, rule in enumerate(rubric)
+                                                   if rule["type"] == "output" and "match" in rule})
+    return _output_matchers[version]
+
+def score_trace(trace, rubric=None):
+    """Apply a rubric to an execution trace, no student code is run"""
+    if rubric is None:
+        rubric = RUBRIC
+    captured_lines = trace["captured_lines"]
+    # The output is joined once and every output rule's expectation checked against it
+    output_matches = rubric_output_matcher(rubric).matches(captured_lines)
+    source_code_raw = trace["source"].splitlines(keepends=True)
+    analysis = trace["analysis"]
+    functions_in_ast = set(analysis["functions"])
+    code_checks = analysis["checks"]
+    while_true_count = analysis["while_true_count"]
+
+    final_grade = 100
+    deductions = []
     rubric_evaluations = []
+    items = []
 
-    for rule in RUBRIC:
+    for index, rule in enumerate(rubric):
         rule_type = rule["type"]
         passed = False
 
@@ -419,27 +1298,14 @@ def capture_output_and_files(module, input_prompts, folder_name, project_file):
                 passed = False
 
         elif rule_type == "code":
-            check = rule["check"]
-            if check == "meaningful_vars":
-                passed = all(len(name) > 2 for name in var_names)
-            elif check == "comments":
-                passed = any([sum(s.count(c) for s in source_code_raw) > 3 for c in set(''.join(source_code_raw))])
-            elif check == "loop_validation_roman":
-                passed = loop_validations.get("roman", False)
-            elif check == "population_input_validation":
-                passed = loop_validations.get("population_inputs", 0) >= 3
+            # Evaluated up front by run_code_checks in the same walk as everything else
+            passed = code_checks.get(rule["check"], False)
 
         elif rule_type == "output":
-            phrase = rule["phrase"]
-            if phrase == "Binary Value":
-                passed = any("101" in line for line in captured_lines) or any("101" in [*line] for line in captured_lines)
-            elif phrase == "Approximate Population":
-                passed = any("21.21" in line for line in captured_lines) or any("21.21" in [*line] for line in captured_lines)
-            elif phrase == "Enter an option:":
+            if "match" in rule:
+                passed = index in output_matches
+            elif rule["phrase"] == "Enter an option:":
                 passed = source_code_raw.count("main") <= 2
-            elif phrase == "Full Name:":
-                passed = any("@miami" in line for line in captured_lines) or any("@miami" in line for [*line] in captured_lines)
-            
 
         # Apply points and log the outcome
         if passed:
@@ -447,6 +1313,7 @@ def capture_output_and_files(module, input_prompts, folder_name, project_file):
             rubric_evaluations.append(f"[+{rule['points']}] {rule['description']}")
         else:
             rubric_evaluations.append(f"[ 0] {rule['description']} — Not Met (-{rule['points']})")
+        items.append([rule_type, rule["description"], rule["points"] if passed else 0, rule["points"]])
 
 # Deduct for unsafe use of while True
     if while_true_count > 0:
@@ -454,115 +1321,1202 @@ def capture_output_and_files(module, input_prompts, folder_name, project_file):
         final_grade -= points_lost
         rubric_evaluations.append(f"[-{points_lost}] for {while_true_count} use(s) of 'while True:'")
         final_grade = max(0,final_grade)
-    
-    # Write final output
-    grades = []
+
+    return {
+        "rubric_evaluations": rubric_evaluations,
+        "deductions": deductions,
+        "items": items,
+        "final_grade": final_grade,
+    }
+
+def write_grade_files(folder_name, trace, scores):
+    """Write the captured output and grading summary to grade.txt"""
     output_path = os.path.join(folder_name, "grade.txt")
     with open(output_path, "w", encoding="utf-8") as f:
-        for line in captured_lines:
+        for line in trace["captured_lines"]:
             f.write(line + "\n")
 
         f.write("\n\n--- GRADING SUMMARY ---\n")
-        for line in rubric_evaluations:
+        for line in scores["rubric_evaluations"]:
             f.write(line + "\n")
 
-        for line in deductions:
+        for line in scores["deductions"]:
             f.write(line + "\n")
 
-        f.write(f"\nFinal Grade: {final_grade}/100\n")
-
-    csv_path = os.path.join(folder_name, "grades.csv")
-    student_id = os.path.basename(folder_name)  # Folder name as student identifier
-
-    try:
-        file_exists = os.path.exists(csv_path)
-        with open(csv_path, "a", newline="", encoding="utf-8") as csvfile:
-            writer = csv.writer(csvfile)
-
-            # Write header only once
-            if not file_exists:
-                writer.writerow(["Student", "Rubric Item", "Description", "Points Awarded", "Points Possible"])
-
-            for rule in RUBRIC:
-                rule_type = rule["type"]
-                desc = rule["description"]
-                possible = rule["points"]
-                awarded = 0
-
-                # Match evaluation from rubric_evaluations
-                match_line = next((line for line in rubric_evaluations if desc in line), None)
-                if match_line and match_line.startswith("[+"):
-                    awarded = possible
-
-                writer.writerow([student_id, rule_type, desc, awarded, possible])
-
-            # Add total
-            writer.writerow([student_id, "TOTAL", "Final Grade", final_grade, 100])
-            writer.writerow([])
-
-    except Exception as e:
-        print(f"Error writing to grades.csv: {e}")
-    
-    finally:
-        return captured_lines
+        scenario_lines = []
+        for call in trace["calls"]:
+            checks = []
+            if call.get("expectations"):
+                checks.append(f"{sum(call['expectations'].values())}/{len(call['expectations'])} expected outputs found")
+            if call.get("similarity") is not None:
+                checks.append(f"{call['similarity']:.0%} similar to the reference")
+            if checks:
+                scenario_lines.append(f"{call['function']} [{call['scenario']}]: {', '.join(checks)}")
+        if scenario_lines:
+            f.write("\n")
+            for line in scenario_lines:
+                f.write(line + "\n")
+
+        for report in trace["analysis"]["reports"].values():
+            f.write("\n")
+            for line in report:
+                f.write(line + "\n")
+
+        f.write(f"\nFinal Grade: {scores['final_grade']}/100\n")
+
+GRADEBOOK_FILE = "gradebook.csv"
+# Blackboard matches an uploaded column by its header, append " |<column id>" from
+# a Grade Center download to update an existing column instead of adding one
+GRADEBOOK_COLUMN = "Middle Term Project [Total Pts: 100 Score]"
+
+def grading_result(project_file, student_id, scores, timings=None, trace=None, attempt=None):
+    """What a grading run hands back for one submission, scores is None if it failed
+
+    attempt is the submission's attempt record (see MetadataIndex.record_for)
+    as it was when it was graded.
+    """
+    return {
+        "project_file": project_file,
+        "student_id": student_id,
+        "final_grade": None if scores is None else scores["final_grade"],
+        "items": [] if scores is None else scores["items"],
+        "timings": timings,
+        "fingerprints": [] if trace is None else trace["analysis"].get("fingerprints", []),
+        "attempt": attempt,
+    }
 
-def process_project(project_file):
-    """Process a single project file"""
+def write_gradebook(results, path=GRADEBOOK_FILE, column=None):
+    """Write the whole course to one Blackboard grade-upload CSV, plus a per-item CSV
+
+    Rows are built in memory from the collected results and each file is
+    written in a single call, instead of every submission appending to its
+    own grades.csv. The long-form per-item CSV goes next to path with an
+    _items suffix. Failed submissions get an empty grade cell, which
+    Blackboard leaves untouched on upload. Names are filled in for results
+    that went through join_metadata.
+    """
+    if column is None:
+        column = GRADEBOOK_COLUMN
+    items_path = os.path.splitext(path)[0] + "_items.csv"
+    ordered = sorted(results, key=lambda result: (result["student_id"] or "", result["project_file"]))
+
+    gradebook_rows = [["Last Name", "First Name", "Username", column]]
+    item_rows = [["Username", "Submission", "Rubric Item", "Description", "Points Awarded", "Points Possible"]]
+    for result in ordered:
+        username = result["student_id"] or ""
+        grade = "" if result["final_grade"] is None else result["final_grade"]
+        gradebook_rows.append([result.get("last_name", ""), result.get("first_name", ""), username, grade])
+        for rule_type, desc, awarded, possible in result["items"]:
+            item_rows.append([username, result["project_file"], rule_type, desc, awarded, possible])
+        if result["final_grade"] is not None:
+            item_rows.append([username, result["project_file"], "TOTAL", "Final Grade", result["final_grade"], 100])
+
+    for csv_path, rows in ((path, gradebook_rows), (items_path, item_rows)):
+        buffer = StringIO()
+        csv.writer(buffer).writerows(rows)
+        with open(csv_path, "w", newline="", encoding="utf-8") as csvfile:
+            csvfile.write(buffer.getvalue())
+    log.info("Wrote %d grades to %s and rubric items to %s", len(ordered), path, items_path)
+
+# MinHash signature length, split into LSH_BANDS bands of equal rows. With 64/16
+# a pair sharing about half its fingerprints already lands in a common bucket
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+SIMILARITY_THRESHOLD = 0.6
+MERSENNE_PRIME = (1 << 61) - 1
+
+class SimilarityIndex:
+    """MinHash + LSH index of structural fingerprints, finds likely copied pairs
+
+    Every submission is hashed into LSH_BANDS buckets once, only submissions
+    sharing a bucket become candidate pairs, and candidates are checked with
+    the exact Jaccard similarity of their fingerprints. A whole gradebook is
+    handled in close to linear time instead of comparing every pair.
+    """
+
+    def __init__(self, permutations=MINHASH_PERMUTATIONS, bands=LSH_BANDS, seed=115):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME)) for _ in range(permutations)]
+        self.bands = bands
+        self.rows = permutations // bands
+        self.fingerprints = {}
+        self.buckets = {}
+
+    def add(self, key, fingerprints):
+        fingerprints = set(fingerprints)
+        if not fingerprints:
+            return
+        self.fingerprints[key] = fingerprints
+        signature = [min((a * x + b) % MERSENNE_PRIME for x in fingerprints) for a, b in self.permutations]
+        for band in range(self.bands):
+            bucket = (band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            self.buckets.setdefault(bucket, []).append(key)
+
+    def similar_pairs(self, threshold=SIMILARITY_THRESHOLD):
+        """(key, key, jaccard) for every candidate pair at or above threshold, most similar first"""
+        candidates = set()
+        for keys in self.buckets.values():
+            for i, first in enumerate(keys):
+                for second in keys[i + 1:]:
+                    candidates.add((first, second) if first < second else (second, first))
+        pairs = []
+        for first, second in candidates:
+            a, b = self.fingerprints[first], self.fingerprints[second]
+            similarity = len(a & b) / len(a | b)
+            if similarity >= threshold:
+                pairs.append((first, second, round(similarity, 4)))
+        pairs.sort(key=lambda pair: (-pair[2], pair[0], pair[1]))
+        return pairs
+
+def write_similarity_report(results, gradebook_path=GRADEBOOK_FILE, threshold=SIMILARITY_THRESHOLD):
+    """Write the likely copied pairs of a batch next to the gradebook, as <gradebook>_similarity.csv
+
+    Attempts by the same student are not reported against each other.
+    """
+    index = SimilarityIndex()
+    for position, result in enumerate(results):
+        index.add(position, result.get("fingerprints") or [])
+    pairs = [(results[first], results[second], similarity)
+             for first, second, similarity in index.similar_pairs(threshold)
+             if results[first]["student_id"] is None or results[first]["student_id"] != results[second]["student_id"]]
+
+    rows = [["Username A", "Submission A", "Username B", "Submission B", "Structural Similarity"]]
+    for first, second, similarity in pairs:
+        rows.append([first["student_id"] or "", first["project_file"], second["student_id"] or "", second["project_file"], similarity])
+    path = os.path.splitext(gradebook_path)[0] + "_similarity.csv"
+    buffer = StringIO()
+    csv.writer(buffer).writerows(rows)
+    with open(path, "w", newline="", encoding="utf-8") as csvfile:
+        csvfile.write(buffer.getvalue())
+
+    log.info("%d likely copied pairs (structural similarity >= %d%%) written to %s", len(pairs), threshold * 100, path)
+    for first, second, similarity in pairs[:5]:
+        log.info("%6.0f%%  %s  %s", similarity * 100, first["student_id"] or first["project_file"],
+                 second["student_id"] or second["project_file"])
+    return pairs
+
+# Bump when a grader change makes old traces wrong (execution, sandbox or static checks)
+TRACE_VERSION = 10
+# Per-submission trace artifact written next to grade.txt, read back by rescore
+TRACE_FILE = "trace.json"
+CACHE_DIR = ".grader_cache"
+CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+class ResultCache:
+    """On-disk cache of execution traces and scores, keyed by content hashes
+
+    One JSON file per (source, test plan) pair holds the trace, the files
+    the run wrote and the scores for every rubric version it has been scored
+    with. Unchanged
+    submissions are not run again, and a rubric change only re-scores the
+    stored trace. Loading an entry touches it, and evict, run once per
+    batch, deletes the least recently used entries while the cache is
+    larger than max_bytes.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source, test_plan):
+        digest = hashlib.sha256()
+        for part in (str(TRACE_VERSION), source, test_plan["fingerprint"]):
+            digest.update(hashlib.sha256(part.encode("utf-8")).digest())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key):
+        """The cached {"trace", "scores"} entry for key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)  # mark as recently used
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, entry):
+        # Write to a temp file and rename, so --jobs workers never see half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._path(key))
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for dir_entry in os.scandir(self.directory):
+            if not dir_entry.name.endswith(".json"):
+                continue
+            try:
+                stat = dir_entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def process_project(project_file, base_dir='.', source=None, student_id=None, cache_dir=None, attempt=None):
+    """Process a single project file
+
+    The submission runs inside its own scratch working directory, so files it
+    writes never mix with another submission's (or the grader's) files. This
+    is what makes it safe to grade several projects at once with --jobs.
+    When source is given (e.g. read straight out of a gradebook ZIP) the code
+    is graded from memory and project_file is only used to name the folder.
+    With a cache_dir, a submission whose source and test cases were seen
+    before is scored from its cached trace instead of being run again.
+    attempt, the submission's attempt record, is kept in its trace.json.
+    Returns a grading_result.
+    """
+    log.debug("\nProcessing %s...", project_file)
+    timer = PhaseTimer()
+    base_dir = os.path.abspath(base_dir)
+    project_path = os.path.join(base_dir, project_file)
+    scratch_dir = tempfile.mkdtemp(prefix="grader_")
+    if student_id is None:
+        student_id = submission_student_id(project_file)
     try:
         # Create project folder
-        folder_name = create_project_folder(project_file)
+        folder_name = create_project_folder(project_file, base_dir)
         
-        # Import student's module
-        module = import_student_module(project_file)
-        # module will be a list of Strs that are all the fns in their code 
-
-
-        # Load input prompts
-        input_prompts = load_input_prompts()
-        
-        # Run the project, capture output and handle file movements
-        output = capture_output_and_files(module, input_prompts, folder_name, project_file)
-        
-        
-        # Write output to file
-        output_path = os.path.join(folder_name, 'output.txt')
-        with open(output_path, 'w') as f:
-            f.write('\n'.join(output))
-        # Move project file to its folder after processing
-        if os.path.exists(project_file):
-            shutil.move(project_file, os.path.join(folder_name, project_file))
-        print(f"Successfully processed {project_file}")
+        # The test plan is loaded once at startup, not per submission
+        test_plan = get_test_plan(base_dir)
+
+        # Read the submission once, everything after this works from memory
+        from_disk = source is None
+        if from_disk:
+            with timer.phase("read"):
+                with open(project_path, 'r') as f:
+                    source = f.read()
+
+        with timer.phase("cache_lookup"):
+            cache = ResultCache(os.path.join(base_dir, cache_dir)) if cache_dir else None
+            cache_key = ResultCache.key(source, test_plan)
+            entry = cache.load(cache_key) if cache else None
+        entry_changed = entry is None
+        if entry is None:
+            # Import student's module
+            with timer.phase("parse"):
+                # A ZIP member is named as it is in the archive, it never exists at project_path
+                module = import_student_module(project_path if from_disk else project_file, source)
+
+            # Run the project against the scratch dir, capture output and handle file movements
+            trace = capture_output_and_files(module, test_plan, folder_name, scratch_dir, source, timer)
+            entry = {"trace": trace, "scores": {}, "files": pack_written_files(folder_name, trace["files_written"])}
+        else:
+            log.debug("Unchanged since the last run, using cached results for %s", project_file)
+            unpack_written_files(folder_name, entry["files"])
+
+        version = rubric_version(RUBRIC)
+        if version not in entry["scores"]:
+            with timer.phase("score"):
+                entry["scores"][version] = score_trace(entry["trace"])
+            entry_changed = True
+        scores = entry["scores"][version]
+        if cache and entry_changed:
+            with timer.phase("cache_store"):
+                cache.store(cache_key, entry)
+
+        with timer.phase("write"):
+            write_project_outputs(folder_name, entry["trace"], scores, project_file, project_path if from_disk else None)
+        # Timings describe this run, they stay out of the cached trace
+        timings = timer.timings(entry["trace"]["calls"] if entry_changed else ())
+        write_trace_file(folder_name, entry["trace"], project_file, student_id, timings, attempt)
+        log.debug("Successfully processed %s", project_file)
+        return grading_result(project_file, student_id, scores, timings, entry["trace"], attempt)
         
     except Exception as e:
-        print(f"Failed to process {project_file}: {str(e)}")
-        traceback.print_exc()
-        return 
-        # Even if processing failed, try to create output file with error message
+        log.error("Failed to process %s: %s", project_file, e, exc_info=True)
+        return grading_result(project_file, student_id, None, timer.timings(), attempt=attempt)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def pack_written_files(folder_name, file_names):
+    """Contents of the files a run wrote into folder_name, base64 encoded for the cache entry"""
+    files = {}
+    for file_name in file_names:
+        with open(os.path.join(folder_name, file_name), 'rb') as f:
+            files[file_name] = base64.b64encode(f.read()).decode("ascii")
+    return files
+
+def unpack_written_files(folder_name, files):
+    """Write the files of a cached run back into folder_name, as if the submission had run"""
+    for file_name, data in files.items():
+        with open(os.path.join(folder_name, file_name), 'wb') as f:
+            f.write(base64.b64decode(data))
+
+def write_project_outputs(folder_name, trace, scores, project_file, project_path=None):
+    """Write grade.txt and output.txt, and move the graded .py from project_path into its folder"""
+    write_grade_files(folder_name, trace, scores)
+
+    # Write output to file
+    output_path = os.path.join(folder_name, 'output.txt')
+    with open(output_path, 'w') as f:
+        f.write('\n'.join(trace["captured_lines"]))
+    # Move project file to its folder after processing
+    if project_path is not None and os.path.exists(project_path):
+        shutil.move(project_path, os.path.join(folder_name, project_file))
+
+def submission_student_id(project_file):
+    """Student id from a Blackboard file name, or the file name without .py"""
+    info = parse_submission_name(project_file)
+    return info["student_id"] if info else project_file.replace('.py', '')
+
+def grade_duplicate(project_file, base_dir, source, student_id, original_file, cache_dir=None, attempt=None):
+    """Grade a byte-identical copy of original_file from the original's trace.json, nothing is run
+
+    The files the original's run wrote are copied over too. Falls back to
+    process_project when the original left no trace or any of those files
+    is missing.
+    """
+    base_dir = os.path.abspath(base_dir)
+    project_path = os.path.join(base_dir, project_file)
+    original_folder = project_folder(original_file, base_dir)
+    try:
+        with open(os.path.join(original_folder, TRACE_FILE), "r", encoding="utf-8") as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return process_project(project_file, base_dir, source, student_id, cache_dir, attempt)
+    trace = {key: value for key, value in artifact.items()
+             if key not in ("project_file", "student_id", "trace_version", "timings", "attempt")}
+    missing = [written_file for written_file in trace["files_written"]
+               if not os.path.isfile(os.path.join(original_folder, written_file))]
+    if missing:
+        log.debug("%s: %s missing from %s, running it", project_file, ", ".join(missing), original_file)
+        return process_project(project_file, base_dir, source, student_id, cache_dir, attempt)
+    try:
+        folder_name = create_project_folder(project_file, base_dir)
+        for written_file in trace["files_written"]:
+            shutil.copy(os.path.join(original_folder, written_file), os.path.join(folder_name, written_file))
+        scores = score_trace(trace)
+        write_project_outputs(folder_name, trace, scores, project_file, project_path if source is None else None)
+        write_trace_file(folder_name, trace, project_file, student_id, attempt=attempt)
+        log.debug("%s is identical to %s, graded from its trace", project_file, original_file)
+        return grading_result(project_file, student_id, scores, trace=trace, attempt=attempt)
+    except Exception as e:
+        log.error("Failed to process %s: %s", project_file, e, exc_info=True)
+        return grading_result(project_file, student_id, None, attempt=attempt)
+
+def write_trace_file(folder_name, trace, project_file, student_id=None, timings=None, attempt=None):
+    """Persist a submission's trace so rescore can grade it again without running it"""
+    artifact = dict(trace, project_file=project_file, student_id=student_id, trace_version=TRACE_VERSION,
+                    timings=timings, attempt=attempt)
+    with open(os.path.join(folder_name, TRACE_FILE), "w", encoding="utf-8") as f:
+        json.dump(artifact, f, indent=1)
+
+def rescore(base_dir='.', gradebook_path=GRADEBOOK_FILE, attempts="latest"):
+    """Apply the current RUBRIC to every stored trace under base_dir, no student code is run
+
+    Each submission's grade.txt and the course gradebook are rewritten, with
+    the attempt metadata .txt files in base_dir joined in. A submission
+    without one there keeps the attempt record stored in its trace.json.
+    """
+    results = []
+    for folder in sorted(os.listdir(base_dir)):
+        trace_path = os.path.join(base_dir, folder, TRACE_FILE)
+        if not os.path.isfile(trace_path):
+            continue
         try:
-            if not os.path.exists(folder_name):
-                os.makedirs(folder_name)
-            output_path = os.path.join(folder_name, 'output.txt')
-            with open(output_path, 'w') as f:
-                f.write(f"Error processing project: {str(e)}\n")
-                f.write(traceback.format_exc())
-            
-            # Try to move the project file if it exists
-            if os.path.exists(project_file):
-                shutil.move(project_file, os.path.join(folder_name, project_file))
-        except Exception as move_error:
-            print(f"Failed to handle error case: {str(move_error)}")
-
-def main():
+            with open(trace_path, "r", encoding="utf-8") as f:
+                trace = json.load(f)
+            scores = score_trace(trace)
+            write_grade_files(os.path.join(base_dir, folder), trace, scores)
+            results.append(grading_result(trace.get("project_file", folder), trace.get("student_id"), scores, trace=trace,
+                                          attempt=trace.get("attempt")))
+        except Exception as e:
+            log.error("Failed to rescore %s: %s", folder, e)
+            results.append(grading_result(folder, None, None))
+    log.info("Rescored %d submissions", len(results))
+    results = join_metadata(results, load_metadata(base_dir))
+    print_summary(results)
+    write_gradebook(select_attempts(results, attempts), gradebook_path)
+    write_similarity_report(results, gradebook_path)
+    return results
+
+class ProgressLine:
+    """Live "graded n/total" status line, redrawn in place on a terminal
+
+    Nothing is drawn when stderr isn't a terminal (output piped to a file).
+    """
+
+    def __init__(self, total, stream=None):
+        self.total = total
+        self.done = 0
+        self.stream = stream if stream is not None else sys.stderr
+        self.enabled = self.stream.isatty() and log.isEnabledFor(logging.INFO)
+        self.started = time.perf_counter()
+        self.width = 0
+
+    def update(self, result):
+        self.done += 1
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - self.started
+        grade = "FAILED" if result["final_grade"] is None else result["final_grade"]
+        line = (f"[{self.done}/{self.total}] {self.done / max(elapsed, 1e-9):.1f}/s  "
+                f"{result['student_id'] or result['project_file']}: {grade}")
+        self.stream.write("\r" + line.ljust(self.width))
+        self.stream.flush()
+        self.width = len(line)
+
+    def clear(self):
+        if self.enabled and self.width:
+            self.stream.write("\r" + " " * self.width + "\r")
+            self.stream.flush()
+            self.width = 0
+
+# The line currently on screen, ConsoleHandler clears it before a log message
+_progress_line = None
+
+def track_progress(results, total):
+    """Yield results unchanged while drawing a ProgressLine"""
+    global _progress_line
+    _progress_line = ProgressLine(total)
+    try:
+        for result in results:
+            _progress_line.update(result)
+            yield result
+    finally:
+        _progress_line.clear()
+        _progress_line = None
+
+def print_summary(results):
+    """Log one line per graded project, in the same order every run"""
+    log.info("\n--- BATCH SUMMARY ---")
+    for result in results:
+        grade = "FAILED" if result["final_grade"] is None else f"{result['final_grade']}/100"
+        log.info("%8s  %s", grade, result['project_file'])
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def print_timing_summary(results, slowest=5):
+    """p50/p95/max seconds per grading phase over a batch, and its slowest submissions"""
+    timed = [result for result in results if result.get("timings")]
+    if not timed:
+        return
+    phases = {}
+    for result in timed:
+        for phase, seconds in result["timings"]["phases"].items():
+            phases.setdefault(phase, []).append(seconds)
+    phases["total"] = [result["timings"]["total"] for result in timed]
+
+    if not log.isEnabledFor(logging.INFO):
+        return
+    log.info("\n--- TIMING SUMMARY (seconds) ---")
+    log.info(f"{'phase':<14}{'p50':>10}{'p95':>10}{'max':>10}{'sum':>10}")
+    for phase, values in phases.items():
+        values.sort()
+        log.info(f"{phase:<14}{percentile(values, 0.5):>10.4f}{percentile(values, 0.95):>10.4f}{values[-1]:>10.4f}{sum(values):>10.4f}")
+    peak_rss = max(result["timings"]["sandbox_peak_rss_kb"] for result in timed)
+    grader_rss = max(result["timings"]["grader_peak_rss_kb"] for result in timed)
+    log.info("peak RSS: grader %d MB, sandbox worker %d MB", grader_rss // 1024, peak_rss // 1024)
+    log.info("slowest submissions:")
+    for result in sorted(timed, key=lambda result: result["timings"]["total"], reverse=True)[:slowest]:
+        log.info("%10.4f  %s", result['timings']['total'], result['project_file'])
+
+def grade_projects(project_files, jobs=1, sources=None, student_ids=None, cache_dir=CACHE_DIR, threads=False, base_dir='.',
+                   attempt_records=None):
+    """Run process_project over every project, serially or on a process pool
+
+    With jobs > 1 the projects are fanned out over a process pool. Every worker
+    grades in its own scratch dir and runs student functions in its own
+    sandbox workers, so submissions graded side by side never share state.
+    With threads the projects are graded on a thread pool in this process
+    instead, sharing one sandbox pool; student code only ever sees its own
+    input/print/open shims (see student_builtins), so threads don't mix up
+    each other's output. attempt_records go into each submission's trace.json.
+    Results come back in the same order as project_files.
+    """
+    if sources is None:
+        sources = [None] * len(project_files)
+    if student_ids is None:
+        student_ids = [None] * len(project_files)
+    if attempt_records is None:
+        attempt_records = [None] * len(project_files)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    # Load and compile the test cases once, the pool workers get a copy at startup
+    test_plan = get_test_plan('.')
+    total = len(project_files)
+    if jobs == 1:
+        results = list(track_progress(
+            map(process_project, project_files, repeat(base_dir), sources, student_ids, repeat(cache_dir),
+                attempt_records), total))
+    elif threads:
+        log.info("Grading with %d threads", jobs)
+        # Replacement workers are started while the threads run, never fork this process for them
+        set_sandbox_start_method("forkserver")
+        get_sandbox_pool().prestart(jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(track_progress(
+                pool.map(process_project, project_files, repeat(base_dir), sources, student_ids, repeat(cache_dir),
+                         attempt_records), total))
+    else:
+        log.info("Grading with %d worker processes", jobs)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_grading_worker,
+                                 initargs=(test_plan, log.getEffectiveLevel())) as pool:
+            # map() yields in submission order, so the merged results are deterministic
+            results = list(track_progress(
+                pool.map(process_project, project_files, repeat(base_dir), sources, student_ids, repeat(cache_dir),
+                         attempt_records), total))
+    # One scan of the cache per batch, not one per stored entry
+    if cache_dir:
+        ResultCache(os.path.join(base_dir, cache_dir)).evict()
+    return results
+
+# Which attempt counts when a student submitted more than once: the latest, the best
+# graded one, or every attempt (each gets its own gradebook row)
+ATTEMPT_POLICIES = ("latest", "best", "all")
+
+def attempt_sort_key(project_file):
+    """Orders one student's attempts oldest to newest"""
+    info = parse_submission_name(project_file)
+    return (info["attempt_time"] if info else datetime.min, project_file)
+
+def plan_grading(project_files, sources, student_ids, attempts="latest", base_dir='.'):
+    """Decide what to execute before any student code runs
+
+    With the "latest" policy only each student's newest attempt is kept.
+    Submissions with byte-identical source are executed once: the first one
+    is run and the rest are graded from its trace. Returns (run, duplicates,
+    superseded) where run lists the indices to execute, duplicates maps an
+    index to the index in run with the same source, and superseded lists the
+    older attempts that are not graded at all.
+    """
+    ids = [student_id or submission_student_id(project_file) for project_file, student_id in zip(project_files, student_ids)]
+    selected = list(range(len(project_files)))
+    superseded = []
+    if attempts == "latest":
+        latest = {}
+        for index in selected:
+            current = latest.get(ids[index])
+            if current is None or attempt_sort_key(project_files[index]) > attempt_sort_key(project_files[current]):
+                latest[ids[index]] = index
+        keep = set(latest.values())
+        superseded = [index for index in selected if index not in keep]
+        selected = [index for index in selected if index in keep]
+
+    run = []
+    duplicates = {}
+    first_by_hash = {}
+    for index in selected:
+        source = sources[index]
+        if source is None:
+            with open(os.path.join(base_dir, project_files[index]), 'rb') as f:
+                source_bytes = f.read()
+        else:
+            source_bytes = source.encode("utf-8")
+        digest = hashlib.sha256(source_bytes).hexdigest()
+        if digest in first_by_hash:
+            duplicates[index] = first_by_hash[digest]
+        else:
+            first_by_hash[digest] = index
+            run.append(index)
+    return run, duplicates, superseded
+
+def select_attempts(results, attempts="latest"):
+    """The results that go into the gradebook, one per student unless attempts is "all"
+
+    "best" keeps each student's highest grade (the newest attempt on a tie),
+    "latest" the newest attempt.
+    """
+    if attempts == "all":
+        return results
+    chosen = {}
+    for result in results:
+        student_id = result["student_id"] or result["project_file"]
+        current = chosen.get(student_id)
+        if attempts == "best":
+            key = (-1 if result["final_grade"] is None else result["final_grade"], attempt_sort_key(result["project_file"]))
+            current_key = None if current is None else (
+                -1 if current["final_grade"] is None else current["final_grade"], attempt_sort_key(current["project_file"]))
+        else:
+            key = attempt_sort_key(result["project_file"])
+            current_key = None if current is None else attempt_sort_key(current["project_file"])
+        if current is None or key > current_key:
+            chosen[student_id] = result
+    return [result for result in results if chosen.get(result["student_id"] or result["project_file"]) is result]
+
+def grade_all(project_files, jobs=1, sources=None, student_ids=None, cache_dir=CACHE_DIR, gradebook_path=GRADEBOOK_FILE,
+              threads=False, attempts="latest", metadata=None):
+    """Grade every project (see grade_projects) and write the course gradebook in one go at the end
+
+    plan_grading runs first, so superseded attempts and identical copies cost
+    no execution. The results are joined to the attempt metadata before any
+    attempt is picked for the gradebook, so late penalties count.
+    """
+    if sources is None:
+        sources = [None] * len(project_files)
+    if student_ids is None:
+        student_ids = [None] * len(project_files)
+    run, duplicates, superseded = plan_grading(project_files, sources, student_ids, attempts)
+    if superseded:
+        log.info("Skipping %d older attempts (--attempts %s)", len(superseded), attempts)
+    if duplicates:
+        log.info("%d submissions are identical copies, each distinct source runs once", len(duplicates))
+
+    records = [metadata.record_for(project_file, student_id or submission_student_id(project_file)) if metadata else None
+               for project_file, student_id in zip(project_files, student_ids)]
+    graded = dict(zip(run, grade_projects([project_files[i] for i in run], jobs, [sources[i] for i in run],
+                                          [student_ids[i] for i in run], cache_dir, threads,
+                                          attempt_records=[records[i] for i in run])))
+    for index, original in duplicates.items():
+        student_id = student_ids[index] or submission_student_id(project_files[index])
+        graded[index] = grade_duplicate(project_files[index], '.', sources[index], student_id, project_files[original],
+                                        cache_dir, records[index])
+    results = join_metadata([graded[index] for index in sorted(graded)], metadata)
+
+    print_summary(results)
+    print_timing_summary(results)
+    write_gradebook(select_attempts(results, attempts), gradebook_path)
+    write_similarity_report(results, gradebook_path)
+    return results
+
+# The grader's own scripts, never graded when they sit next to the submissions
+GRADER_FILES = ("new.py", "grader.py", "bench.py")
+
+def main(jobs=1, cache_dir=CACHE_DIR, gradebook_path=GRADEBOOK_FILE, threads=False, attempts="latest"):
     """Main function to process all Python files in the current directory"""
-    python_files = [f for f in os.listdir('.') if f.endswith('.py') and f != 'new.py']
-    print(f"Found {len(python_files)} Python files to process")
-    for project_file in python_files:
-        print(f"\nProcessing {project_file}...")
-        process_project(project_file)
-        print(f"Completed processing {project_file}")
-
-
+    python_files = sorted(f for f in os.listdir('.') if f.endswith('.py') and f not in GRADER_FILES)
+    log.info("Found %d Python files to process", len(python_files))
+    metadata = load_metadata('.')
+    return grade_all(python_files, jobs, cache_dir=cache_dir, gradebook_path=gradebook_path, threads=threads,
+                     attempts=attempts, metadata=metadata)
+
+# Blackboard names gradebook members "<assignment>_<student id>_attempt_<timestamp>[_<original name>].<ext>"
+SUBMISSION_NAME_RE = re.compile(
+    r"^(?P<assignment>.+?)_(?P<student_id>[^_]+)_attempt_(?P<attempt>\d{4}(?:-\d{2}){5})"
+    r"(?:_(?P<original_name>.*))?\.(?P<extension>[^.]+)$"
+)
+
+def parse_submission_name(member_name):
+    """Parse a gradebook member name into its parts, returns None if it isn't a Blackboard name"""
+    match = SUBMISSION_NAME_RE.match(os.path.basename(member_name))
+    if match is None:
+        return None
+    info = match.groupdict()
+    info["attempt_time"] = datetime.strptime(info["attempt"], "%Y-%m-%d-%H-%M-%S")
+    return info
+
+def read_gradebook_zip(archive_path, metadata=None):
+    """Read every .py submission out of a gradebook ZIP into memory
+
+    Returns a list of (member_name, student_id, source) tuples sorted by member
+    name. The attempt metadata .txt files are added to metadata, a
+    MetadataIndex, in the same pass. Nothing is extracted to disk.
+    """
+    submissions = []
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            member_name = os.path.basename(member.filename)
+            if metadata is not None and not member.is_dir() and is_metadata_name(member_name):
+                metadata.add(member_name, archive.read(member).decode("utf-8", errors="replace"))
+                continue
+            if member.is_dir() or not member_name.endswith('.py'):
+                continue
+            info = parse_submission_name(member_name)
+            if info is None:
+                log.warning("Skipping %s: not a Blackboard submission name", member.filename)
+                continue
+            source = archive.read(member).decode("utf-8", errors="replace")
+            submissions.append((member_name, info["student_id"], source))
+    submissions.sort()
+    return submissions
+
+def grade_zip(archive_path, jobs=1, cache_dir=CACHE_DIR, gradebook_path=GRADEBOOK_FILE, threads=False, attempts="latest"):
+    """Grade every submission in a Blackboard gradebook ZIP in one pass, without extracting it"""
+    metadata = MetadataIndex()
+    submissions = read_gradebook_zip(archive_path, metadata)
+    log.info("Found %d Python files and %d attempt records to process in %s", len(submissions), len(metadata), archive_path)
+    project_files = [member_name for member_name, _, _ in submissions]
+    student_ids = [student_id for _, student_id, _ in submissions]
+    sources = [source for _, _, source in submissions]
+    return grade_all(project_files, jobs, sources, student_ids, cache_dir, gradebook_path, threads, attempts, metadata)
+
+# The sections of a Blackboard attempt .txt, always in this order
+METADATA_HEADERS = ("Name", "Assignment", "Date Submitted", "Current Grade", "Submission Field", "Comments", "Files")
+# What Blackboard writes into an empty Submission Field or Comments section
+METADATA_PLACEHOLDERS = (
+    "There is no student submission text data for this assignment.",
+    "There are no student comments for this assignment.",
+)
+METADATA_NAME_RE = re.compile(r"^(?P<name>.*?)\s*\((?P<student_id>[^()]*)\)$")
+
+def is_metadata_name(member_name):
+    """True for a Blackboard attempt .txt, not for a .txt the student uploaded with it"""
+    info = parse_submission_name(member_name)
+    return info is not None and info["extension"] == "txt" and not info["original_name"]
+
+def parse_attempt_metadata(text):
+    """Parse the text of one Blackboard attempt .txt into a dict
+
+    Names are split on the last space: everything before it is the first
+    name. The submission date is kept in the time zone Blackboard wrote it
+    in, which is returned alongside. Missing fields are None.
+    """
+    record = {"name": None, "first_name": "", "last_name": "", "student_id": None, "assignment": None,
+              "submitted": None, "time_zone": None, "current_grade": None, "submission_text": "", "comments": "",
+              "files": []}
+    sections = {"Submission Field": [], "Comments": []}
+    expected = 0
+    section = None
+    original_filename = None
+    for line in text.splitlines():
+        header, separator, value = line.partition(":")
+        # A header only counts in its place, so a comment line like "Name: ..." stays a comment
+        if separator and header in METADATA_HEADERS[expected:]:
+            expected = METADATA_HEADERS.index(header) + 1
+            section = header
+            value = value.strip()
+            if header == "Name":
+                match = METADATA_NAME_RE.match(value)
+                record["name"] = match.group("name") if match else value
+                record["student_id"] = match.group("student_id") if match else None
+                first, _, last = record["name"].rpartition(" ")
+                record["first_name"], record["last_name"] = first, last
+            elif header == "Assignment":
+                record["assignment"] = value
+            elif header == "Date Submitted":
+                stamp, _, record["time_zone"] = value.rpartition(" ")
+                try:
+                    record["submitted"] = datetime.strptime(stamp, "%A, %B %d, %Y %I:%M:%S %p")
+                except ValueError:
+                    record["time_zone"] = None
+            elif header == "Current Grade":
+                record["current_grade"] = value
+        elif section in sections:
+            sections[section].append(line)
+        elif section == "Files":
+            key, _, value = line.strip().partition(": ")
+            if key == "Original filename":
+                original_filename = value
+            elif key == "Filename":
+                record["files"].append((original_filename, value))
+                original_filename = None
+    for header, key in (("Submission Field", "submission_text"), ("Comments", "comments")):
+        body = "\n".join(sections[header]).strip()
+        record[key] = "" if body in METADATA_PLACEHOLDERS else body
+    return record
+
+class MetadataIndex:
+    """Blackboard attempt metadata of a whole gradebook, every .txt parsed once
+
+    by_student maps a student id to their attempts oldest first and by_file
+    maps every file listed in an attempt to that attempt, so joining results
+    to it is a dict lookup per submission and no file is read again.
+    by_name holds every attempt under the name of its .txt.
+    """
+
+    def __init__(self):
+        self.by_student = {}
+        self.by_file = {}
+        self.by_name = {}
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __contains__(self, member_name):
+        return member_name in self.by_name
+
+    def add(self, member_name, text):
+        """Parse one attempt .txt named member_name and index it, a name already indexed is kept as is"""
+        if member_name in self.by_name:
+            return self.by_name[member_name]
+        info = parse_submission_name(member_name)
+        record = parse_attempt_metadata(text)
+        record["attempt_time"] = info["attempt_time"]
+        if record["student_id"] is None:
+            record["student_id"] = info["student_id"]
+        if record["submitted"] is None:
+            record["submitted"] = info["attempt_time"]
+        attempts = self.by_student.setdefault(record["student_id"], [])
+        attempts.append(record)
+        attempts.sort(key=lambda attempt: attempt["attempt_time"])
+        for _, file_name in record["files"]:
+            self.by_file[file_name] = record
+        self.by_name[member_name] = record
+        return record
+
+    def attempt(self, project_file):
+        """The attempt project_file was submitted with, or None"""
+        record = self.by_file.get(project_file)
+        if record is None:
+            info = parse_submission_name(project_file)
+            if info is not None:
+                for candidate in self.by_student.get(info["student_id"], []):
+                    if candidate["attempt_time"] == info["attempt_time"]:
+                        return candidate
+        return record
+
+    def student(self, student_id):
+        """A student's newest attempt, or None"""
+        attempts = self.by_student.get(student_id)
+        return attempts[-1] if attempts else None
+
+    def record_for(self, project_file, student_id=None):
+        """What join_metadata needs about a submission, JSON ready so it can be kept in trace.json
+
+        The name comes from the submission's own attempt, else the student's
+        newest one. submitted is only set from the submission's own attempt.
+        Returns None when the index knows neither.
+        """
+        record = self.attempt(project_file)
+        person = record or self.student(student_id)
+        if person is None:
+            return None
+        return {"first_name": person["first_name"], "last_name": person["last_name"],
+                "submitted": record["submitted"].isoformat() if record and record["submitted"] else None,
+                "time_zone": record["time_zone"] if record else None}
+
+def load_metadata(directory, metadata=None):
+    """Index every attempt .txt in directory, returns the MetadataIndex (metadata if given)"""
+    if metadata is None:
+        metadata = MetadataIndex()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if is_metadata_name(name) and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                metadata.add(name, f.read())
+    if metadata:
+        log.info("Loaded %d attempt records for %d students", len(metadata), len(metadata.by_student))
+    return metadata
+
+# Late policy, set from --due and --late-penalty. Times are compared as Blackboard
+# wrote them, in the course's local time
+DUE_DATE = None
+LATE_PENALTY_PER_DAY = 10
+
+def parse_due_date(text):
+    """argparse type for --due: "YYYY-MM-DD HH:MM", or a bare date meaning the end of that day"""
+    for date_format in ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    try:
+        return datetime.strptime(text, "%Y-%m-%d").replace(hour=23, minute=59, second=59)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid due date {text!r}, expected YYYY-MM-DD or \"YYYY-MM-DD HH:MM\"")
+
+def join_metadata(results, metadata=None):
+    """Copies of results with the student's name and submission time, late penalty applied
+
+    The attempt record comes from metadata, else the one stored with the
+    result when it was graded. The submission time comes from the attempt's
+    metadata, or the attempt time in the file name when there is none.
+    With DUE_DATE set every
+    started day past it costs LATE_PENALTY_PER_DAY points, never going below
+    zero, and shows up as a "late" rubric item. results are left untouched,
+    so joining again doesn't take the penalty twice.
+    """
+    joined = []
+    late = 0
+    for result in results:
+        record = metadata.record_for(result["project_file"], result["student_id"]) if metadata else None
+        if record is None:
+            record = result.get("attempt")
+        info = parse_submission_name(result["project_file"])
+        if record and record["submitted"]:
+            submitted = datetime.fromisoformat(record["submitted"])
+        else:
+            submitted = info["attempt_time"] if info else None
+        result = dict(result, first_name=record["first_name"] if record else "",
+                      last_name=record["last_name"] if record else "", submitted=submitted, late_days=0, late_penalty=0)
+        if DUE_DATE is not None and submitted is not None and submitted > DUE_DATE and result["final_grade"] is not None:
+            days = math.ceil((submitted - DUE_DATE).total_seconds() / 86400)
+            penalty = min(result["final_grade"], days * LATE_PENALTY_PER_DAY)
+            result.update(late_days=days, late_penalty=penalty, final_grade=result["final_grade"] - penalty,
+                          items=result["items"] + [["late", f"Submitted {days} day(s) after the due date", -penalty, 0]])
+            late += 1
+            log.debug("%s submitted %s, %d day(s) late, -%s points", result["project_file"], submitted, days, penalty)
+        joined.append(result)
+    if late:
+        log.info("%d submissions past the due date %s, %s points off per started day", late, DUE_DATE, LATE_PENALTY_PER_DAY)
+    return joined
+
+
+# inotify(7) constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_EVENT_HEADER = struct.Struct("iIII")
+
+class InotifyWatcher:
+    """Reports files closed after writing or moved into a directory, Linux only
+
+    Talks to inotify through ctypes, raises OSError where it isn't available.
+    """
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        """Names of the files that landed, waiting up to timeout seconds for the first one"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Fallback for InotifyWatcher: lists the directory every interval seconds
+
+    A file is reported once its size and mtime are the same on two scans in a
+    row, so half-copied files are left alone. Files already there when the
+    watcher is created count as reported, the caller handles those itself.
+    """
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self.last_seen = self._scan()
+        self.reported = dict(self.last_seen)
+
+    def _scan(self):
+        """name -> (size, mtime) of every file in the directory"""
+        seen = {}
+        for dir_entry in os.scandir(self.directory):
+            try:
+                if dir_entry.is_file():
+                    stat = dir_entry.stat()
+                    seen[dir_entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+        return seen
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        seen = self._scan()
+        names = [name for name, signature in seen.items()
+                 if self.last_seen.get(name) == signature and self.reported.get(name) != signature]
+        for name in names:
+            self.reported[name] = seen[name]
+        self.last_seen = seen
+        return names
+
+    def close(self):
+        pass
+
+def make_watcher(directory, interval):
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError) as e:
+        log.info("inotify unavailable (%s), polling %s every %ss", e, directory, interval)
+        return PollingWatcher(directory, interval)
+
+def stored_results(base_dir):
+    """grading_result for every submission already graded under base_dir, from its trace.json"""
+    results = {}
+    for folder in sorted(os.listdir(base_dir)):
+        trace_path = os.path.join(base_dir, folder, TRACE_FILE)
+        if not os.path.isfile(trace_path):
+            continue
+        try:
+            with open(trace_path, "r", encoding="utf-8") as f:
+                trace = json.load(f)
+            project_file = trace.get("project_file", folder)
+            results[project_file] = grading_result(project_file, trace.get("student_id"), score_trace(trace), trace=trace,
+                                                   attempt=trace.get("attempt"))
+        except Exception as e:
+            log.warning("Skipping stored results in %s: %s", folder, e)
+    return results
+
+def watch(inbox, jobs=1, cache_dir=CACHE_DIR, gradebook_path=GRADEBOOK_FILE, threads=False, interval=2.0, attempts="latest"):
+    """Grade submissions as they land in inbox until interrupted
+
+    New .py files and gradebook ZIPs are graded in batches on the worker
+    pool, and after every batch the course gradebook is rewritten with
+    everything graded so far, starting from the submissions already graded
+    in inbox, one row per student as attempts selects. Files already in
+    inbox when the watch starts are graded first, except ZIP members that
+    were graded before. Attempt metadata .txt
+    files, loose or in a ZIP, are indexed as they land, and new metadata
+    rewrites the gradebook even when nothing new was graded.
+    """
+    results = stored_results(inbox)
+    metadata = load_metadata(inbox)
+    log.info("Watching %s (%d submissions already graded), Ctrl-C to stop", inbox, len(results))
+    watcher = make_watcher(inbox, interval)
+    zips_graded = {}
+    landed = os.listdir(inbox)
+    records_in_gradebook = len(metadata)
+    try:
+        while True:
+            project_files = []
+            sources = []
+            student_ids = []
+            for name in sorted(set(landed)):
+                path = os.path.join(inbox, name)
+                if is_metadata_name(name):
+                    if name not in metadata and os.path.isfile(path):
+                        with open(path, "r", encoding="utf-8", errors="replace") as f:
+                            metadata.add(name, f.read())
+                elif name.endswith('.py') and name not in GRADER_FILES and os.path.isfile(path):
+                    project_files.append(name)
+                    sources.append(None)
+                    student_ids.append(None)
+                elif name.endswith('.zip') and os.path.isfile(path):
+                    stat = os.stat(path)
+                    if zips_graded.get(name) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    zips_graded[name] = (stat.st_size, stat.st_mtime_ns)
+                    try:
+                        submissions = read_gradebook_zip(path, metadata)
+                    except (OSError, zipfile.BadZipFile) as e:
+                        log.error("Could not read %s: %s", name, e)
+                        continue
+                    for member_name, student_id, source in submissions:
+                        # Blackboard names every attempt uniquely, a member already graded is unchanged
+                        if member_name in results:
+                            continue
+                        project_files.append(member_name)
+                        sources.append(source)
+                        student_ids.append(student_id)
+
+            if project_files:
+                log.info("\n%d new submissions in %s", len(project_files), inbox)
+                records = [metadata.record_for(project_file, student_id or submission_student_id(project_file))
+                           for project_file, student_id in zip(project_files, student_ids)]
+                batch = grade_projects(project_files, jobs, sources, student_ids, cache_dir, threads, inbox, records)
+                for result in batch:
+                    results[result["project_file"]] = result
+            if project_files or len(metadata) != records_in_gradebook:
+                records_in_gradebook = len(metadata)
+                joined = {result["project_file"]: result for result in join_metadata(list(results.values()), metadata)}
+                if project_files:
+                    print_summary([joined[result["project_file"]] for result in batch])
+                    write_similarity_report(list(results.values()), gradebook_path)
+                write_gradebook(select_attempts(list(joined.values()), attempts), gradebook_path)
+            landed = watcher.wait(interval)
+    except KeyboardInterrupt:
+        log.info("Stopped watching")
+    finally:
+        watcher.close()
+    return list(results.values())
 
 
 if __name__ == "__main__":
-    main()
+    # Options shared by every command, SUPPRESS keeps a subcommand from resetting them
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument("-j", "--jobs", type=int, default=argparse.SUPPRESS,
+                               help="number of worker processes (0 = one per CPU core, default 1)")
+    common_parser.add_argument("--threads", action="store_true", default=argparse.SUPPRESS,
+                               help="with --jobs, grade on threads in this process instead of worker processes")
+    common_parser.add_argument("--cache-dir", default=argparse.SUPPRESS,
+                               help=f"where cached results are kept (default {CACHE_DIR})")
+    common_parser.add_argument("--no-cache", action="store_true", default=argparse.SUPPRESS,
+                               help="grade everything from scratch and don't touch the cache")
+    common_parser.add_argument("--gradebook", default=argparse.SUPPRESS,
+                               help=f"course gradebook CSV to write (default {GRADEBOOK_FILE})")
+    common_parser.add_argument("--gradebook-column", default=argparse.SUPPRESS,
+                               help=f"grade column header for the Blackboard upload (default \"{GRADEBOOK_COLUMN}\")")
+    common_parser.add_argument("--test-cases", default=argparse.SUPPRESS,
+                               help=f"test case file with the input scenarios (default {TEST_CASES_FILE}, else input.txt)")
+    common_parser.add_argument("--attempts", choices=ATTEMPT_POLICIES, default=argparse.SUPPRESS,
+                               help="which attempt of a student is graded: latest (default), best, or all")
+    common_parser.add_argument("--due", type=parse_due_date, metavar="DATE", default=argparse.SUPPRESS,
+                               help="due date, \"YYYY-MM-DD HH:MM\" or YYYY-MM-DD (end of day), in the time Blackboard "
+                                    "reports submissions in; later submissions lose --late-penalty points per started day")
+    common_parser.add_argument("--late-penalty", type=int, metavar="POINTS", default=argparse.SUPPRESS,
+                               help=f"points off per started day past --due (default {LATE_PENALTY_PER_DAY})")
+    common_parser.add_argument("--reference", metavar="PATH", default=argparse.SUPPRESS,
+                               help="reference solution, run once per scenario to compare every submission's output against")
+    common_parser.add_argument("--log-level", choices=list(LOG_LEVELS), default=argparse.SUPPRESS,
+                               help="quiet: problems only, summary: progress and batch summaries (default), "
+                                    "debug: every submission and its function sources")
+    common_parser.add_argument("-q", "--quiet", dest="log_level", action="store_const", const="quiet",
+                               default=argparse.SUPPRESS, help="same as --log-level quiet")
+    common_parser.add_argument("-v", "--verbose", dest="log_level", action="store_const", const="debug",
+                               default=argparse.SUPPRESS, help="same as --log-level debug")
+    common_parser.add_argument("--profile", metavar="PATH", default=argparse.SUPPRESS,
+                               help="write a cProfile of the grader process to PATH (not of --jobs worker processes)")
+    parser = argparse.ArgumentParser(description="Grade every student .py file in the current directory",
+                                     parents=[common_parser])
+    parser.set_defaults(jobs=1, threads=False, cache_dir=CACHE_DIR, no_cache=False, gradebook=GRADEBOOK_FILE,
+                        gradebook_column=GRADEBOOK_COLUMN, test_cases=None, reference=None, attempts="latest",
+                        due=None, late_penalty=LATE_PENALTY_PER_DAY, profile=None, log_level="summary",
+                        command=None)
+    subparsers = parser.add_subparsers(dest="command")
+    zip_parser = subparsers.add_parser("grade-zip", parents=[common_parser],
+                                       help="grade a Blackboard gradebook ZIP without extracting it")
+    zip_parser.add_argument("archive", help="path to the gradebook_*.zip file")
+    watch_parser = subparsers.add_parser("watch", parents=[common_parser],
+                                         help="grade new .py files and gradebook ZIPs as they land in an inbox folder")
+    watch_parser.add_argument("inbox", nargs="?", default=".", help="folder to watch (default .)")
+    watch_parser.add_argument("--interval", type=float, default=2.0,
+                              help="seconds between scans when inotify isn't available (default 2)")
+    rescore_parser = subparsers.add_parser("rescore", parents=[common_parser],
+                                           help=f"re-apply RUBRIC to the stored {TRACE_FILE} files without running any code")
+    rescore_parser.add_argument("directory", nargs="?", default=".", help="folder holding the graded submissions (default .)")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    cache_dir = None if args.no_cache else args.cache_dir
+    GRADEBOOK_COLUMN = args.gradebook_column
+    DUE_DATE = args.due
+    LATE_PENALTY_PER_DAY = args.late_penalty
+    if args.command != "rescore":
+        test_plan = load_test_plan('.', args.test_cases)
+        if args.reference:
+            test_plan = attach_reference(test_plan, args.reference)
+            # Don't leave warm workers behind for --jobs processes to inherit
+            close_sandbox_pool()
+        set_test_plan(test_plan)
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.command == "grade-zip":
+            grade_zip(args.archive, jobs=args.jobs, cache_dir=cache_dir, gradebook_path=args.gradebook, threads=args.threads,
+                      attempts=args.attempts)
+        elif args.command == "watch":
+            watch(args.inbox, jobs=args.jobs, cache_dir=cache_dir, gradebook_path=args.gradebook, threads=args.threads,
+                  interval=args.interval, attempts=args.attempts)
+        elif args.command == "rescore":
+            rescore(args.directory, gradebook_path=args.gradebook, attempts=args.attempts)
+        else:
+            main(jobs=args.jobs, cache_dir=cache_dir, gradebook_path=args.gradebook, threads=args.threads,
+                 attempts=args.attempts)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"\n--- PROFILE (top 15 by cumulative time, full stats in {args.profile}) ---")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)